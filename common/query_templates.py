@@ -0,0 +1,138 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compiled, cached SQL query templates with typed parameter binding.
+
+Templates are Jinja2 templates compiled once and cached by the hash of their
+source. Query parameters are bound with the filters below, which validate the
+values and format them as BigQuery Standard SQL literals:
+
+  sql_identifier  A table or a column name, e.g. `{{ table | sql_identifier }}`
+  sql_string      A quoted string literal
+  sql_int         An integer literal
+  sql_number      An integer or a floating point literal
+  sql_date        A DATE literal from a YYYY-MM-DD string or a date
+  sql_list        A comma separated list of literals, e.g. IN ({{ lots | sql_list }})
+
+The pipelines compile their queries with this module, and the labs import it
+from the common folder at the root of the repo.
+"""
+
+import datetime
+import hashlib
+import numbers
+import re
+
+import jinja2
+
+# KFP pipeline parameter placeholders are resolved at run time
+_PIPELINE_PARAM = re.compile(r'^\{\{pipelineparam:[^{}]*\}\}$')
+_IDENTIFIER = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.:-]*$')
+
+_templates = {}
+
+
+def sql_identifier(value):
+  """Validates a table or a column name."""
+
+  value = str(value)
+  if not (_IDENTIFIER.match(value) or _PIPELINE_PARAM.match(value)):
+    raise ValueError('Invalid SQL identifier: {!r}'.format(value))
+  return value
+
+
+def sql_string(value):
+  """Formats a string literal."""
+
+  value = str(value)
+  if _PIPELINE_PARAM.match(value):
+    return "'{}'".format(value)
+  return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def sql_int(value):
+  """Formats an integer literal."""
+
+  if isinstance(value, bool) or not isinstance(value, numbers.Integral):
+    raise ValueError('Invalid SQL integer: {!r}'.format(value))
+  return str(int(value))
+
+
+def sql_number(value):
+  """Formats an integer or a floating point literal."""
+
+  if isinstance(value, bool) or not isinstance(value, numbers.Real):
+    raise ValueError('Invalid SQL number: {!r}'.format(value))
+  return repr(value) if isinstance(value, float) else str(int(value))
+
+
+def sql_date(value):
+  """Formats a DATE literal."""
+
+  if not isinstance(value, datetime.date):
+    value = datetime.datetime.strptime(str(value), '%Y-%m-%d').date()
+  return "DATE '{}'".format(value.isoformat())
+
+
+def sql_list(values):
+  """Formats a comma separated list of literals."""
+
+  values = list(values)
+  if not values:
+    raise ValueError('Empty SQL list')
+  return ', '.join(
+      sql_string(value) if isinstance(value, str) else sql_number(value)
+      for value in values)
+
+
+_environment = jinja2.Environment(undefined=jinja2.StrictUndefined)
+_environment.filters.update({
+    'sql_identifier': sql_identifier,
+    'sql_string': sql_string,
+    'sql_int': sql_int,
+    'sql_number': sql_number,
+    'sql_date': sql_date,
+    'sql_list': sql_list,
+})
+
+
+def get_template(source):
+  """Returns the compiled template, compiling it on the first use."""
+
+  key = hashlib.sha256(source.encode('utf-8')).hexdigest()
+  template = _templates.get(key)
+  if template is None:
+    template = _templates[key] = _environment.from_string(source)
+  return template
+
+
+def render(source, **params):
+  """Renders a query template with the parameters."""
+
+  return get_template(source).render(**params)
+
+
+def render_file(path, **params):
+  """Renders a query template file with the parameters."""
+
+  with open(path) as template_file:
+    return render(template_file.read(), **params)
+
+
+def fingerprint(query):
+  """Returns a fingerprint of a query that can be used as a cache key.
+
+  Queries that differ only in whitespace get the same fingerprint.
+  """
+
+  return hashlib.sha256(' '.join(query.split()).encode('utf-8')).hexdigest()
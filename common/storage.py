@@ -0,0 +1,428 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-process, streaming artifact storage for local and GCS paths.
+
+Files opened for writing are published at their path when they are closed.
+If the with block that writes a file raises, or if abort() is called before
+closing it, the file is discarded and nothing is written to its path.
+
+The labs and the examples copy this module into their images, see the
+Dockerfiles.
+"""
+
+import concurrent.futures
+import hashlib
+import io
+import os
+import shutil
+import uuid
+
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_WORKERS = 8
+# The maximum number of source objects in a single GCS compose request
+MAX_COMPOSE_COMPONENTS = 32
+READ_BLOCK_SIZE = 1 << 20
+
+
+def _split_gcs_path(path):
+  """Splits a gs://bucket/name path into the bucket and the object name."""
+
+  bucket_name, _, blob_name = path[len('gs://'):].partition('/')
+  return bucket_name, blob_name
+
+
+class _AbortOnError(object):
+  """Aborts the write of a file when its with block raises."""
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None:
+      abort(self)
+    return super(_AbortOnError, self).__exit__(exc_type, exc_value, traceback)
+
+
+class _BufferedWriter(_AbortOnError, io.BufferedWriter):
+  pass
+
+
+class _TextWriter(_AbortOnError, io.TextIOWrapper):
+  pass
+
+
+def _writer(raw, mode, buffer_size=io.DEFAULT_BUFFER_SIZE):
+  """Wraps a raw writer in a binary or a text stream."""
+
+  stream = _BufferedWriter(raw, buffer_size=buffer_size)
+  return stream if 'b' in mode else _TextWriter(stream)
+
+
+class _LocalWriter(io.FileIO):
+  """A local file written to a temporary path and renamed on close."""
+
+  def __init__(self, path):
+    self._path = path
+    self._temporary_path = '{}.tmp-{}'.format(path, uuid.uuid4().hex)
+    self._aborted = False
+    super(_LocalWriter, self).__init__(self._temporary_path, 'wb')
+
+  def abort(self):
+    self._aborted = True
+
+  def close(self):
+    if self.closed:
+      return
+    super(_LocalWriter, self).close()
+    if self._aborted:
+      os.remove(self._temporary_path)
+    else:
+      os.replace(self._temporary_path, self._path)
+
+
+class LocalStorage(object):
+  """Storage backend for the local filesystem."""
+
+  def open(self, path, mode='rb'):
+    if 'w' not in mode:
+      return open(path, mode)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return _writer(_LocalWriter(path), mode)
+
+  def exists(self, path):
+    return os.path.exists(path)
+
+  def size(self, path):
+    return os.path.getsize(path)
+
+  def fingerprint(self, path):
+    """Returns the SHA-256 digest of the file's content."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as local_file:
+      for block in iter(lambda: local_file.read(READ_BLOCK_SIZE), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+class _GCSReader(io.RawIOBase):
+  """A readable stream that downloads a GCS object in ranged requests."""
+
+  def __init__(self, blob):
+    super(_GCSReader, self).__init__()
+    self._blob = blob
+    self._size = blob.size
+    self._position = 0
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def tell(self):
+    return self._position
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_CUR:
+      offset += self._position
+    elif whence == io.SEEK_END:
+      offset += self._size
+    self._position = max(0, offset)
+    return self._position
+
+  def readinto(self, buffer):
+    end = min(self._position + len(buffer), self._size)
+    if end <= self._position:
+      return 0
+    data = _download_range(self._blob, self._position, end)
+    buffer[:len(data)] = data
+    self._position += len(data)
+    return len(data)
+
+
+class _GCSBufferedReader(io.BufferedIOBase):
+  """Buffers a _GCSReader without being an io.BufferedReader.
+
+  numpy takes io.BufferedReader streams for real files and reads them with
+  fromfile(), which needs a fileno().
+  """
+
+  def __init__(self, raw, buffer_size):
+    super(_GCSBufferedReader, self).__init__()
+    self._stream = io.BufferedReader(raw, buffer_size=buffer_size)
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def read(self, size=-1):
+    return self._stream.read(size)
+
+  def read1(self, size=-1):
+    return self._stream.read1(size)
+
+  def readinto(self, buffer):
+    return self._stream.readinto(buffer)
+
+  def readline(self, size=-1):
+    return self._stream.readline(size)
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    return self._stream.seek(offset, whence)
+
+  def tell(self):
+    return self._stream.tell()
+
+  def close(self):
+    self._stream.close()
+    super(_GCSBufferedReader, self).close()
+
+
+class _GCSWriter(_AbortOnError, io.BufferedIOBase):
+  """A writable stream that uploads a GCS object as parallel composite parts.
+
+  The stream buffers the writes itself, so that it is not an
+  io.BufferedWriter, which numpy would take for a real file with a fileno().
+  Every chunk_size bytes written are uploaded as a temporary part object in a
+  thread pool. On close, the parts are composed into the destination object
+  and deleted. Objects smaller than one chunk are uploaded directly. If the
+  writer is aborted or an upload fails, the parts are deleted and the
+  destination object is left untouched.
+  """
+
+  def __init__(self, bucket, blob_name, chunk_size, max_workers):
+    super(_GCSWriter, self).__init__()
+    self._bucket = bucket
+    self._blob_name = blob_name
+    self._chunk_size = chunk_size
+    self._buffer = bytearray()
+    self._part_prefix = '{}.part-{}-'.format(blob_name, uuid.uuid4().hex)
+    self._parts = []
+    self._position = 0
+    self._aborted = False
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+  def writable(self):
+    return True
+
+  def tell(self):
+    return self._position
+
+  def abort(self):
+    self._aborted = True
+
+  def write(self, data):
+    self._position += len(data)
+    if self._aborted:
+      return len(data)
+    self._buffer.extend(data)
+    while len(self._buffer) >= self._chunk_size:
+      self._upload_part(bytes(self._buffer[:self._chunk_size]))
+      del self._buffer[:self._chunk_size]
+    return len(data)
+
+  def _upload_part(self, data):
+    part = self._bucket.blob('{}{:05d}'.format(self._part_prefix,
+                                               len(self._parts)))
+    self._parts.append((part, self._executor.submit(part.upload_from_string,
+                                                    data)))
+
+  def close(self):
+    if self.closed:
+      return
+    try:
+      if self._aborted:
+        self._delete_parts()
+      elif not self._parts:
+        self._bucket.blob(self._blob_name).upload_from_string(
+            bytes(self._buffer))
+      else:
+        if self._buffer:
+          self._upload_part(bytes(self._buffer))
+        try:
+          for _, upload in self._parts:
+            upload.result()
+        except Exception:
+          self._delete_parts()
+          raise
+        self._compose([part for part, _ in self._parts])
+    finally:
+      self._executor.shutdown()
+      super(_GCSWriter, self).close()
+
+  def _delete_parts(self):
+    """Deletes the parts that were uploaded, once all uploads are done."""
+
+    for part, upload in self._parts:
+      if upload.exception() is None:
+        part.delete()
+
+  def _compose(self, parts):
+    """Composes the parts into the destination object and deletes them."""
+
+    temporary = []
+    while len(parts) > MAX_COMPOSE_COMPONENTS:
+      groups = [parts[i:i + MAX_COMPOSE_COMPONENTS]
+                for i in range(0, len(parts), MAX_COMPOSE_COMPONENTS)]
+      parts = []
+      for group in groups:
+        composed = self._bucket.blob('{}c{:05d}'.format(
+            self._part_prefix, len(temporary)))
+        composed.compose(group)
+        temporary.append(composed)
+        parts.append(composed)
+    self._bucket.blob(self._blob_name).compose(parts)
+
+    for part in [part for part, _ in self._parts] + temporary:
+      part.delete()
+
+
+def _download_range(blob, start, end):
+  """Downloads the [start, end) byte range of a GCS object."""
+
+  download = getattr(blob, 'download_as_bytes', None) or blob.download_as_string
+  return download(start=start, end=end - 1)
+
+
+class GCSStorage(object):
+  """Storage backend for Google Cloud Storage."""
+
+  def __init__(self, client=None, chunk_size=CHUNK_SIZE,
+               max_workers=MAX_WORKERS):
+    if client is None:
+      from google.cloud import storage  # pylint: disable=g-import-not-at-top
+      client = storage.Client()
+    self._client = client
+    self._chunk_size = chunk_size
+    self._max_workers = max_workers
+
+  def _blob(self, path):
+    bucket_name, blob_name = _split_gcs_path(path)
+    return self._client.bucket(bucket_name).get_blob(blob_name)
+
+  def open(self, path, mode='rb'):
+    if 'w' in mode:
+      bucket_name, blob_name = _split_gcs_path(path)
+      writer = _GCSWriter(self._client.bucket(bucket_name), blob_name,
+                          self._chunk_size, self._max_workers)
+      return writer if 'b' in mode else _TextWriter(writer)
+    blob = self._blob(path)
+    if blob is None:
+      raise IOError('No such object: {}'.format(path))
+    if 'b' in mode:
+      return _GCSBufferedReader(_GCSReader(blob), self._chunk_size)
+    return io.TextIOWrapper(
+        io.BufferedReader(_GCSReader(blob), buffer_size=self._chunk_size))
+
+  def exists(self, path):
+    return self._blob(path) is not None
+
+  def size(self, path):
+    return self._blob(path).size
+
+  def fingerprint(self, path):
+    """Returns a digest of the object's MD5 hash, read from its metadata.
+
+    Composite objects have no MD5 hash, so their path and generation are used
+    instead. Either changes when the object is overwritten.
+    """
+
+    blob = self._blob(path)
+    if blob is None:
+      raise IOError('No such object: {}'.format(path))
+    if blob.md5_hash:
+      key = 'md5:{}'.format(blob.md5_hash)
+    else:
+      key = '{}#{}'.format(path, blob.generation)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+  def download(self, path, local_file):
+    """Downloads an object into an open file with parallel ranged requests."""
+
+    blob = self._blob(path)
+    if blob is None:
+      raise IOError('No such object: {}'.format(path))
+    ranges = [(start, min(start + self._chunk_size, blob.size))
+              for start in range(0, blob.size, self._chunk_size)]
+
+    local_file.truncate(blob.size)
+    def download_range(byte_range):
+      os.pwrite(local_file.fileno(), _download_range(blob, *byte_range),
+                byte_range[0])
+    with concurrent.futures.ThreadPoolExecutor(self._max_workers) as executor:
+      list(executor.map(download_range, ranges))
+
+
+_local_storage = LocalStorage()
+_gcs_storage = None
+
+
+def get_storage(path):
+  """Returns the storage backend for a path."""
+
+  global _gcs_storage
+  if not path.startswith('gs://'):
+    return _local_storage
+  if _gcs_storage is None:
+    _gcs_storage = GCSStorage()
+  return _gcs_storage
+
+
+def open_file(path, mode='rb'):
+  """Opens a local or a GCS file as a stream."""
+
+  return get_storage(path).open(path, mode)
+
+
+def abort(stream):
+  """Discards a file opened for writing with open_file, when it is closed.
+
+  Used on error paths that close the file without a with block.
+  """
+
+  stream = getattr(stream, 'buffer', stream)
+  getattr(stream, 'raw', stream).abort()
+
+
+def exists(path):
+  """Checks whether a local or a GCS file exists."""
+
+  return get_storage(path).exists(path)
+
+
+def fingerprint(path):
+  """Returns a digest that changes when the content of a file changes.
+
+  Local files are hashed. For GCS objects, only the metadata is read.
+  """
+
+  return get_storage(path).fingerprint(path)
+
+
+def copy(source_path, destination_path):
+  """Copies a file between local and GCS paths.
+
+  GCS objects are downloaded to local files with parallel ranged requests and
+  uploaded as parallel composite parts.
+  """
+
+  source = get_storage(source_path)
+  destination = get_storage(destination_path)
+  if isinstance(source, GCSStorage) and isinstance(destination, LocalStorage):
+    with destination.open(destination_path, 'wb') as destination_file:
+      source.download(source_path, destination_file)
+    return
+  with source.open(source_path, 'rb') as source_file:
+    with destination.open(destination_path, 'wb') as destination_file:
+      shutil.copyfileobj(source_file, destination_file, CHUNK_SIZE)
@@ -0,0 +1,193 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the storage module, with an in-memory fake of GCS."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import joblib
+import numpy as np
+
+import storage
+
+
+class FakeBlob(object):
+  """An object of a FakeBucket."""
+
+  def __init__(self, bucket, name):
+    self._bucket = bucket
+    self.name = name
+    self.generation = bucket.generations.get(name)
+    self.md5_hash = None
+
+  @property
+  def size(self):
+    return len(self._bucket.objects[self.name])
+
+  def upload_from_string(self, data):
+    if self._bucket.fail_uploads:
+      raise IOError('Upload failed')
+    self._set(bytes(data))
+
+  def _set(self, data):
+    self._bucket.objects[self.name] = data
+    self._bucket.generations[self.name] = self._bucket.generations.get(
+        self.name, 0) + 1
+
+  def download_as_bytes(self, start=0, end=None):
+    data = self._bucket.objects[self.name]
+    return data[start:None if end is None else end + 1]
+
+  def compose(self, sources):
+    self._set(b''.join(
+        self._bucket.objects[source.name] for source in sources))
+
+  def delete(self):
+    del self._bucket.objects[self.name]
+
+
+class FakeBucket(object):
+  """A bucket that keeps its objects in a dict."""
+
+  def __init__(self):
+    self.objects = {}
+    self.generations = {}
+    self.fail_uploads = False
+
+  def blob(self, name):
+    return FakeBlob(self, name)
+
+  def get_blob(self, name):
+    return FakeBlob(self, name) if name in self.objects else None
+
+
+class FakeClient(object):
+  """A client with a single FakeBucket."""
+
+  def __init__(self):
+    self.fake_bucket = FakeBucket()
+
+  def bucket(self, name):
+    del name
+    return self.fake_bucket
+
+
+class GCSStorageTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = FakeClient()
+    self.objects = self.client.fake_bucket.objects
+    self.storage = storage.GCSStorage(self.client, chunk_size=16,
+                                      max_workers=2)
+
+  def test_write_composes_parts(self):
+    with self.storage.open('gs://bucket/data.bin', 'wb') as data_file:
+      data_file.write(b'x' * 100)
+      self.assertEqual(data_file.tell(), 100)
+    self.assertEqual(self.objects, {'data.bin': b'x' * 100})
+
+  def test_write_fails_without_publishing(self):
+    for mode, data in [('wb', b'x' * 100), ('w', 'x' * 100), ('wb', b'x')]:
+      with self.assertRaises(ValueError):
+        with self.storage.open('gs://bucket/data', mode) as data_file:
+          data_file.write(data)
+          raise ValueError('Failed while writing')
+      self.assertEqual(self.objects, {})
+
+  def test_abort(self):
+    data_file = self.storage.open('gs://bucket/data.csv', 'w')
+    data_file.write('a,b\n' * 100)
+    storage.abort(data_file)
+    data_file.close()
+    self.assertEqual(self.objects, {})
+
+  def test_failed_upload_deletes_parts(self):
+    data_file = self.storage.open('gs://bucket/data.bin', 'wb')
+    data_file.write(b'x' * 40)
+    self.client.fake_bucket.fail_uploads = True
+    data_file.write(b'x' * 40)
+    with self.assertRaises(IOError):
+      data_file.close()
+    self.assertEqual(self.objects, {})
+
+  def test_fingerprint_changes_with_generation(self):
+    path = 'gs://bucket/data.csv'
+    with self.storage.open(path, 'w') as data_file:
+      data_file.write('a,b\n')
+    fingerprint = self.storage.fingerprint(path)
+    self.assertEqual(self.storage.fingerprint(path), fingerprint)
+    with self.storage.open(path, 'w') as data_file:
+      data_file.write('a,b\n')
+    self.assertNotEqual(self.storage.fingerprint(path), fingerprint)
+
+  def test_joblib_and_numpy_round_trip(self):
+    array = np.arange(1000, dtype=np.float64)
+    with self.storage.open('gs://bucket/array.npy', 'wb') as array_file:
+      np.save(array_file, array)
+    with self.storage.open('gs://bucket/model.joblib', 'wb') as model_file:
+      joblib.dump({'array': array}, model_file)
+
+    with self.storage.open('gs://bucket/array.npy', 'rb') as array_file:
+      np.testing.assert_array_equal(np.load(array_file), array)
+    with self.storage.open('gs://bucket/model.joblib', 'rb') as model_file:
+      np.testing.assert_array_equal(joblib.load(model_file)['array'], array)
+
+
+class LocalStorageTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'output', 'data.csv')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_write(self):
+    with storage.open_file(self.path, 'w') as data_file:
+      data_file.write('a,b\n')
+      self.assertFalse(os.path.exists(self.path))
+    with storage.open_file(self.path) as data_file:
+      self.assertEqual(data_file.read(), b'a,b\n')
+
+  def test_write_fails_without_publishing(self):
+    with self.assertRaises(ValueError):
+      with storage.open_file(self.path, 'wb') as data_file:
+        data_file.write(b'a,b\n')
+        raise ValueError('Failed while writing')
+    self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+  def test_fingerprint_hashes_content(self):
+    with storage.open_file(self.path, 'w') as data_file:
+      data_file.write('a,b\n')
+    self.assertEqual(storage.fingerprint(self.path),
+                     hashlib.sha256(b'a,b\n').hexdigest())
+
+  def test_copy_from_gcs(self):
+    client = FakeClient()
+    client.fake_bucket.objects['data.bin'] = b'x' * 100
+    gcs_storage = storage.GCSStorage(client, chunk_size=16, max_workers=2)
+    storage._gcs_storage, previous = gcs_storage, storage._gcs_storage
+    try:
+      storage.copy('gs://bucket/data.bin', self.path)
+    finally:
+      storage._gcs_storage = previous
+    with open(self.path, 'rb') as data_file:
+      self.assertEqual(data_file.read(), b'x' * 100)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -17,4 +17,7 @@ IMAGE_NAME=dask_ml_trainer
 IMAGE_TAG=latest
 IMAGE_URI=gcr.io/$PROJECT_ID/$IMAGE_NAME:$IMAGE_TAG
 
-gcloud builds submit --tag $IMAGE_URI .
\ No newline at end of file
+# The image is built from the root of the repo, to vendor common/storage.py
+cd ../..
+gcloud builds submit --config common/cloudbuild.yaml \
+  --substitutions _IMAGE_URI=$IMAGE_URI,_DOCKERFILE=examples/dask-ml/Dockerfile .
\ No newline at end of file
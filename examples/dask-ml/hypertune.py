@@ -12,37 +12,79 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import importlib
 import joblib
 import logging
 import os
-import subprocess
-import sys
+import resource
 import time
 
 import fire
 import pickle
 import numpy as np
 import pandas as pd
+import psutil
+import storage
 
-from dask.distributed import Client, LocalCluster
+import dask.array as da
+from dask.distributed import Client, LocalCluster, get_client
 from dask_ml.model_selection import GridSearchCV
+from dask_ml.model_selection import HyperbandSearchCV, SuccessiveHalvingSearchCV
 
+from sklearn import model_selection
+from sklearn.base import clone
 from sklearn.linear_model import SGDClassifier
 #from sklearn.model_selection import GridSearchCV
 from sklearn.compose import ColumnTransformer
+from sklearn.model_selection import ParameterGrid
 from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import StandardScaler, OneHotEncoder
+from sklearn.preprocessing import StandardScaler, OneHotEncoder, OrdinalEncoder
  
 NUMERIC_FEATURE_INDEXES = slice(0, 10)
 CATEGORICAL_FEATURE_INDEXES = slice(10, 12)
+FEATURE_LAYOUTS = ('csr', 'dense', 'codes')
+SEARCH_STRATEGIES = ('grid', 'halving', 'hyperband')
 MODEL_FILE='model.joblib'
+PREPROCESSING_CACHE_DIR = '/tmp/preprocessing_cache'
+
+
+def build_preprocessor(feature_layout='csr'):
+  """Builds the feature preprocessing transformer.
+
+  The feature_layout controls the matrix the transformer outputs:
+    - csr: scaled numeric and one-hot encoded categorical features in a CSR
+      matrix, the natural input of linear models
+    - dense: the same features in a dense matrix with the numeric features
+      in the leading columns
+    - codes: scaled numeric features followed by one integer category code per
+      categorical feature, for estimators that handle categories natively
+  """
+
+  if feature_layout == 'csr':
+    encoder = OneHotEncoder(dtype=np.float32)
+    sparse_threshold = 1.0
+  elif feature_layout == 'dense':
+    encoder = OneHotEncoder(sparse=False, dtype=np.float32)
+    sparse_threshold = 0.0
+  elif feature_layout == 'codes':
+    encoder = OrdinalEncoder(dtype=np.float32)
+    sparse_threshold = 0.0
+  else:
+    raise ValueError('Unknown feature layout: {}. Expected one of: {}'.format(
+        feature_layout, FEATURE_LAYOUTS))
+
+  return ColumnTransformer(
+    transformers=[
+        ('num', StandardScaler(), NUMERIC_FEATURE_INDEXES),
+        ('cat', encoder, CATEGORICAL_FEATURE_INDEXES) 
+    ],
+    sparse_threshold=sparse_threshold)
 
   
-def train_evaluate(job_dir, training_dataset_path, search_space, scoring_measure):
-  """Runs the training pipeline.""" 
+def load_training_data(training_dataset_path):
+  """Loads the training data."""
 
-  # Load and prepare training data  
   df_train = pd.read_csv(training_dataset_path)
   num_features_type_map = (
     {feature: 'float64' for feature in df_train.columns[NUMERIC_FEATURE_INDEXES]})
@@ -50,30 +92,242 @@ def train_evaluate(job_dir, training_dataset_path, search_space, scoring_measure
   X_train = df_train.drop('Cover_Type', axis=1)
   y_train = df_train['Cover_Type']
 
-  # Define the training pipeline
-  preprocessor = ColumnTransformer(
+  return X_train, y_train
+
+
+def build_encoder():
+  """Builds the transformer that encodes raw features as a float64 array.
+
+  The numeric features are passed through and the categorical features are
+  replaced with their ordinal codes, so the columns keep their positions.
+  """
+
+  return ColumnTransformer(
     transformers=[
-        ('num', StandardScaler(), NUMERIC_FEATURE_INDEXES),
-        ('cat', OneHotEncoder(), CATEGORICAL_FEATURE_INDEXES) 
-    ])
+        ('num', 'passthrough', NUMERIC_FEATURE_INDEXES),
+        ('cat', OrdinalEncoder(), CATEGORICAL_FEATURE_INDEXES)
+    ],
+    sparse_threshold=0.0)
+
+
+def _reduce_cache_size(memory, cache_size_mb):
+  """Evicts the least recently used cache entries above cache_size_mb."""
+
+  bytes_limit = int(cache_size_mb * 2**20)
+  try:
+    memory.reduce_size(bytes_limit=bytes_limit)
+  except TypeError:
+    # Older joblib versions take the limit as a Memory attribute
+    memory.bytes_limit = bytes_limit
+    memory.reduce_size()
+
 
+class _BoundedMemory(joblib.Memory):
+  """A joblib.Memory that trims its cache to cache_size_mb after every call.
+
+  The functions cached by a Pipeline run in the search tasks, so the limit is
+  enforced while the search runs. The cache exceeds it at most by the entries
+  of the calls in flight.
+  """
+
+  def __init__(self, location, cache_size_mb, verbose=0):
+    super(_BoundedMemory, self).__init__(location=location, verbose=verbose)
+    self.cache_size_mb = cache_size_mb
+
+  def cache(self, func=None, **kwargs):
+    if func is None:
+      return functools.partial(self.cache, **kwargs)
+    cached_func = super(_BoundedMemory, self).cache(func, **kwargs)
+
+    @functools.wraps(func)
+    def call_and_reduce(*args, **kwargs):
+      try:
+        return cached_func(*args, **kwargs)
+      finally:
+        _reduce_cache_size(self, self.cache_size_mb)
+
+    return call_and_reduce
+
+
+def train_evaluate(job_dir, training_dataset_path, search_space, scoring_measure, feature_layout='csr',
+                   broadcast_data=True, cache_dir=PREPROCESSING_CACHE_DIR, cache_size_mb=1024):
+  """Runs the training pipeline.
+
+  With broadcast_data, the training data is encoded as contiguous NumPy arrays
+  and scattered once to every Dask worker. Each CV task then receives the fold
+  as index arrays and indexes the worker's copy of the data, instead of the
+  graph carrying a copy of the DataFrames per fold. The indexing copies the
+  rows of the fold, so a task still holds one fold in memory while it runs.
+  The RSS of the workers is logged before and after the scatter. Otherwise
+  the search runs with dask_ml.model_selection.GridSearchCV on the
+  DataFrames.
+
+  If cache_dir is set, the fitted preprocessor and the transformed training
+  fold are memoized in a local joblib cache keyed by the preprocessor
+  parameters and the fold data. The preprocessor is then fitted once per fold
+  and every classifier candidate reuses the transformed matrices. The least
+  recently used entries are evicted after every cached call, so the cache is
+  kept at about cache_size_mb during the search.
+  Returns the best score and the best pipeline.
+  """ 
+
+  # Load and prepare training data  
+  X_train, y_train = load_training_data(training_dataset_path)
+
+  # Define the training pipeline
+  memory = _BoundedMemory(cache_dir, cache_size_mb) if cache_dir else None
   pipeline = Pipeline([
-    ('preprocessor', preprocessor),
+    ('preprocessor', build_preprocessor(feature_layout)),
     ('classifier', SGDClassifier())
-  ])
+  ], memory=memory)
   
-  # Configure hyperparameter tuning
-  grid = GridSearchCV(pipeline, cv=5,  
-                      param_grid=search_space, 
-                      scoring=scoring_measure)
+  if not broadcast_data:
+    # Configure hyperparameter tuning
+    grid = GridSearchCV(pipeline, cv=5,  
+                        param_grid=search_space, 
+                        scoring=scoring_measure)
   
-  # Start training
-  grid.fit(X_train, y_train)
+    # Start training
+    grid.fit(X_train, y_train)
     
-  return grid
+    return grid.best_score_, grid.best_estimator_
+
+  encoder = build_encoder()
+  X_train = np.ascontiguousarray(encoder.fit_transform(X_train), dtype=np.float64)
+  y_train = np.ascontiguousarray(y_train.values)
+
+  grid = model_selection.GridSearchCV(pipeline, cv=5,
+                                      param_grid=search_space,
+                                      scoring=scoring_measure,
+                                      n_jobs=-1)
+  client = get_client()
+  _log_worker_rss(client, 'before the scatter')
+  with joblib.parallel_backend('dask', scatter=[X_train, y_train]):
+    _log_worker_rss(client, 'after the scatter')
+    grid.fit(X_train, y_train)
+
+  best_estimator = Pipeline([
+    ('encoder', encoder),
+    ('model', grid.best_estimator_)
+  ])
+
+  return grid.best_score_, best_estimator
+
+
+def _rss_mb():
+  """Returns the resident set size of the current process in MB."""
+
+  return psutil.Process().memory_info().rss / 2**20
+
+
+def _log_worker_rss(client, label):
+  """Logs the resident set size of every Dask worker."""
+
+  for worker, rss in sorted(client.run(_rss_mb).items()):
+    logging.info("RSS of worker {} {}: {:.1f} MB".format(worker, label, rss))
+
+
+def _peak_rss_mb():
+  """Returns the peak resident set size of the current process in MB."""
+
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _incremental_search_space(search_space):
+  """Returns the parameters of the classifiers that support partial_fit.
+
+  The incremental strategies control the number of passes over the data
+  themselves, so max_iter is dropped from the parameters.
+  """
+
+  parameters = []
+  for classifier in search_space:
+    estimator = classifier['classifier'][0]
+    if not hasattr(estimator, 'partial_fit'):
+      logging.info('Skipping {} - it does not support partial_fit'.format(
+          type(estimator).__name__))
+      continue
+    params = {name.split('__', 1)[1]: values
+              for name, values in classifier.items()
+              if name != 'classifier' and name != 'classifier__max_iter'}
+    parameters.append((estimator, params))
+
+  return parameters
+
+
+def train_evaluate_incremental(training_dataset_path, search_space, scoring_measure, search,
+                               feature_layout='dense', max_iter=27, n_initial_iter=3, chunk_size=10000,
+                               random_state=None):
+  """Runs an adaptive search that drops poor configs after a few partial_fit calls.
+
+  The preprocessor is fitted once and the search runs on the transformed data
+  split into blocks of chunk_size rows. The blocks are dense, so the csr
+  feature_layout is replaced with the dense one, which holds the same
+  features. Each partial_fit call consumes one block, so early rounds evaluate
+  the configs on a subsample of the data. The halving search trains every
+  config for n_initial_iter calls before dropping the poor ones. random_state
+  seeds the searches and the classifiers that take one. Returns the best score and the best
+  pipeline.
+  """
+
+  if feature_layout == 'csr':
+    logging.info('The incremental search runs on dense blocks, using the dense feature layout')
+    feature_layout = 'dense'
+
+  X_train, y_train = load_training_data(training_dataset_path)
+  preprocessor = build_preprocessor(feature_layout)
+  X_train = preprocessor.fit_transform(X_train)
+  y_train = y_train.values
+  classes = np.unique(y_train)
+
+  X_train = da.from_array(X_train, chunks=(chunk_size, X_train.shape[1]))
+  y_train = da.from_array(y_train, chunks=chunk_size)
+
+  best_score, best_estimator = None, None
+  for estimator, parameters in _incremental_search_space(search_space):
+    if 'random_state' in estimator.get_params():
+      estimator = clone(estimator).set_params(random_state=random_state)
+    if search == 'halving':
+      searcher = SuccessiveHalvingSearchCV(
+          estimator, parameters, n_initial_parameters=len(ParameterGrid(parameters)),
+          n_initial_iter=n_initial_iter, max_iter=max_iter,
+          scoring=scoring_measure, random_state=random_state)
+    else:
+      searcher = HyperbandSearchCV(
+          estimator, parameters, max_iter=max_iter,
+          scoring=scoring_measure, random_state=random_state)
+    searcher.fit(X_train, y_train, classes=classes)
+
+    if best_score is None or searcher.best_score_ > best_score:
+      best_score, best_estimator = searcher.best_score_, searcher.best_estimator_
+
+  pipeline = Pipeline([
+    ('preprocessor', preprocessor),
+    ('classifier', best_estimator)
+  ])
+
+  return best_score, pipeline
+
     
-def run_dask_job(job_dir, training_dataset_path, search_space, scoring_measure, n_workers=None, threads_per_worker=None):
-  """Runs a parallel training job."""
+def run_dask_job(job_dir, training_dataset_path, search_space, scoring_measure, n_workers=None, threads_per_worker=None,
+                 feature_layout='csr', search='grid', max_iter=27, n_initial_iter=3, chunk_size=10000,
+                 broadcast_data=True, cache_dir=PREPROCESSING_CACHE_DIR, cache_size_mb=1024,
+                 random_state=None):
+  """Runs a parallel training job.
+
+  search is one of SEARCH_STRATEGIES or a comma separated list of them. When
+  several strategies are given, they run one after another, their wall-clock
+  times, best scores and worker peak RSS are logged side by side, and the best
+  model is saved. Every strategy runs in a fresh local Dask cluster, so the
+  peak RSS of its workers is not carried over from a previous strategy.
+  random_state seeds the halving and hyperband searches and their classifiers.
+  """
+
+  strategies = search.split(',') if isinstance(search, str) else list(search)
+  for strategy in strategies:
+    if strategy not in SEARCH_STRATEGIES:
+      raise ValueError('Unknown search strategy: {}. Expected one of: {}'.format(
+          strategy, SEARCH_STRATEGIES))
   
   # Configure parameter grid
   for classifier in search_space:
@@ -81,28 +335,50 @@ def run_dask_job(job_dir, training_dataset_path, search_space, scoring_measure,
     ClassifierClass = getattr(importlib.import_module(module_name), class_name)
     classifier["classifier"] = [ClassifierClass()]
     
-  # Set up a local Dask cluster
-  cluster = LocalCluster(n_workers=n_workers, processes=True, threads_per_worker=threads_per_worker)
-  client = Client(cluster)
-  logging.info("Cluster: {}".format(cluster))
-    
-  logging.info("Starting training ...")
-  t0= time.time()
-  result = train_evaluate(job_dir, training_dataset_path, search_space, scoring_measure)
-  t1 = time.time()
-  logging.info("Elapsed time: {}".format(t1-t0))
-  logging.info("Best accuracy: {}".format(result.best_score_))
-  logging.info("Best estimater: {}".format(result.best_estimator_))
+  results = []
+  for strategy in strategies:
+    # Set up a local Dask cluster
+    cluster = LocalCluster(n_workers=n_workers, processes=True, threads_per_worker=threads_per_worker)
+    client = Client(cluster)
+    logging.info("Cluster: {}".format(cluster))
+    try:
+      _log_worker_rss(client, 'at startup')
+      logging.info("Starting training with the {} search ...".format(strategy))
+      t0= time.time()
+      if strategy == 'grid':
+        best_score, best_estimator = train_evaluate(
+            job_dir, training_dataset_path, search_space, scoring_measure, feature_layout, broadcast_data,
+            cache_dir, cache_size_mb)
+      else:
+        best_score, best_estimator = train_evaluate_incremental(
+            training_dataset_path, search_space, scoring_measure, strategy,
+            feature_layout, max_iter, n_initial_iter, chunk_size, random_state)
+      t1 = time.time()
+      logging.info("Elapsed time: {}".format(t1-t0))
+      logging.info("Best accuracy: {}".format(best_score))
+      logging.info("Best estimater: {}".format(best_estimator))
+      peak_rss = client.run(_peak_rss_mb)
+      for worker, worker_peak_rss in sorted(peak_rss.items()):
+        logging.info("Peak RSS of worker {}: {:.1f} MB".format(worker, worker_peak_rss))
+    finally:
+      client.close()
+      cluster.close()
+    results.append((strategy, t1-t0, best_score, max(peak_rss.values()), best_estimator))
+
+  logging.info("{:>10} {:>12} {:>12} {:>16}".format(
+      'search', 'elapsed', 'best score', 'max worker peak'))
+  for strategy, elapsed, best_score, peak_rss, _ in results:
+    logging.info("{:>10} {:>11.1f}s {:>12.4f} {:>13.1f} MB".format(
+        strategy, elapsed, best_score, peak_rss))
+  _, _, _, _, best_estimator = max(results, key=lambda result: result[2])
  
   # Persist the pipeline
   if job_dir[0:2] == 'gs':
-    joblib.dump(result.best_estimator_, MODEL_FILE)
     model_path = "{}/model/{}".format(job_dir, MODEL_FILE)
-    subprocess.check_call(['gsutil', 'cp', MODEL_FILE, model_path], stderr=sys.stdout)
-    
   else:
     model_path = os.path.join(job_dir, MODEL_FILE)
-    joblib.dump(result.best_estimator_, model_path)
+  with storage.open_file(model_path, 'wb') as model_file:
+    joblib.dump(best_estimator, model_file)
     
   logging.info("Saved model in: {}".format(model_path))
     
@@ -26,7 +26,9 @@ SEARCH_SPACE="[\
 N_WORKERS=4
 THREADS_PER_WORKER=2
 JOB_DIR=/tmp
+# One of grid, halving, hyperband or a comma separated list to compare them
+SEARCH=grid
 
-python hypertune.py $JOB_DIR $TRAINING_DATASET $SEARCH_SPACE $SCORING_MEASURE $N_WORKERS $THREADS_PER_WORKER
+PYTHONPATH=../../common python hypertune.py $JOB_DIR $TRAINING_DATASET $SEARCH_SPACE $SCORING_MEASURE $N_WORKERS $THREADS_PER_WORKER --search=$SEARCH
 echo "Done"
 
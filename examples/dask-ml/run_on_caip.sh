@@ -36,6 +36,7 @@ CPU_NUMBER=64
 MASTER_MACHINE_TYPE=n1-highmem-${CPU_NUMBER}
 THREADS_PER_WORKER=4
 N_WORKERS=16
+SEARCH=grid
 
 
 gcloud ai-platform jobs submit training $JOB_NAME \
@@ -47,7 +48,8 @@ gcloud ai-platform jobs submit training $JOB_NAME \
 -- \
 --training_dataset_path=$TRAINING_DATASET \
 --search_space=$SEARCH_SPACE \
---scoring_measure=$SCORING_MEASURE 
+--scoring_measure=$SCORING_MEASURE \
+--search=$SEARCH
 #--n_workers=$N_WORKERS \
 #--threads_per_worker=$THREADS_PER_WORKER
 
@@ -0,0 +1,206 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A local fake of the AI Platform Training jobs.get API.
+
+The server serves a minimal discovery document and hyperparameter tuning
+jobs with synthetic trials, so retrieve_best_run can be checked without a
+GCP project:
+
+  python fake_ml_api.py check
+"""
+
+import http.server
+import json
+import random
+import re
+import shutil
+import tempfile
+import threading
+
+import fire
+
+from helper_components import retrieve_best_run
+
+DISCOVERY_DOCUMENT = {
+    'kind': 'discovery#restDescription',
+    'discoveryVersion': 'v1',
+    'id': 'ml:v1',
+    'name': 'ml',
+    'version': 'v1',
+    'rootUrl': 'https://ml.googleapis.com/',
+    'servicePath': '',
+    'batchPath': 'batch',
+    'protocol': 'rest',
+    'parameters': {},
+    'schemas': {
+        'GoogleCloudMlV1__Job': {
+            'id': 'GoogleCloudMlV1__Job',
+            'type': 'object',
+        },
+    },
+    'resources': {
+        'projects': {
+            'resources': {
+                'jobs': {
+                    'methods': {
+                        'get': {
+                            'id': 'ml.projects.jobs.get',
+                            'path': 'v1/{+name}',
+                            'flatPath': 'v1/projects/{projectsId}/jobs/'
+                                        '{jobsId}',
+                            'httpMethod': 'GET',
+                            'parameters': {
+                                'name': {
+                                    'location': 'path',
+                                    'required': True,
+                                    'type': 'string',
+                                    'pattern': '^projects/[^/]+/jobs/[^/]+$',
+                                },
+                            },
+                            'parameterOrder': ['name'],
+                            'response': {'$ref': 'GoogleCloudMlV1__Job'},
+                        },
+                    },
+                },
+            },
+        },
+    },
+}
+_JOB_PATH = re.compile(r'^/v1/projects/([^/]+)/jobs/([^/?]+)')
+
+
+def tuning_job(job_id, num_trials=100, goal='MAXIMIZE', state='SUCCEEDED',
+               seed=0):
+  """Returns a tuning job with shuffled trials, some of them failed."""
+
+  rng = random.Random(seed)
+  trials = []
+  for trial_id in range(1, num_trials + 1):
+    trial = {
+        'trialId': str(trial_id),
+        'hyperparameters': {
+            'alpha': str(rng.uniform(0.00001, 0.001)),
+            'max_iter': str(rng.choice([200, 500])),
+        },
+    }
+    if rng.random() < 0.9:
+      trial['finalMetric'] = {'trainingStep': '1',
+                              'objectiveValue': rng.random()}
+    else:
+      trial['state'] = 'FAILED'
+    trials.append(trial)
+
+  return {
+      'jobId': job_id,
+      'state': state,
+      'trainingInput': {'hyperparameters': {'goal': goal,
+                                            'maxTrials': num_trials}},
+      'trainingOutput': {'isHyperparameterTuningJob': True,
+                         'trials': trials},
+  }
+
+
+class FakeMlApi(object):
+  """Serves the discovery document and the jobs on a local port."""
+
+  def __init__(self, jobs, port=0):
+    self.jobs = jobs
+    self.requests = []
+    api = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+      def do_GET(self):  # pylint: disable=invalid-name
+        api.requests.append(self.path)
+        match = _JOB_PATH.match(self.path)
+        if self.path.startswith('/$discovery/rest'):
+          self._send(200, DISCOVERY_DOCUMENT)
+        elif match and match.group(2) in api.jobs:
+          self._send(200, api.jobs[match.group(2)])
+        else:
+          self._send(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+      def _send(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+      def log_message(self, *args):
+        pass
+
+    self.server = http.server.HTTPServer(('localhost', port), Handler)
+    self.endpoint = 'http://localhost:{}'.format(self.server.server_port)
+
+  def __enter__(self):
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    return self
+
+  def __exit__(self, *args):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+def serve(port=8080, num_trials=100, goal='MAXIMIZE'):
+  """Serves a tuning job with the id 'tuning_job' until interrupted."""
+
+  api = FakeMlApi({'tuning_job': tuning_job('tuning_job', num_trials, goal)},
+                  port)
+  print('Serving on {}'.format(api.endpoint))
+  api.server.serve_forever()
+
+
+def check(num_trials=1000, top_k=5):
+  """Checks the ranking and the caching of retrieve_best_run."""
+
+  jobs = {
+      'maximize': tuning_job('maximize', num_trials, 'MAXIMIZE'),
+      'minimize': tuning_job('minimize', num_trials, 'MINIMIZE'),
+      'running': tuning_job('running', num_trials, state='RUNNING'),
+  }
+  cache_dir = tempfile.mkdtemp()
+  try:
+    with FakeMlApi(jobs) as api:
+      for job_id, job in sorted(jobs.items()):
+        values = sorted(
+            trial['finalMetric']['objectiveValue']
+            for trial in job['trainingOutput']['trials']
+            if 'finalMetric' in trial)
+        if job['trainingInput']['hyperparameters']['goal'] == 'MAXIMIZE':
+          values.reverse()
+
+        for _ in range(3):
+          outputs = retrieve_best_run('project', job_id, top_k, cache_dir,
+                                      api.endpoint)
+        top_trials = json.loads(outputs[4])
+        assert outputs[0] == values[0], (outputs[0], values[0])
+        assert [trial['objective_value'] for trial in top_trials
+               ] == values[:top_k]
+        assert outputs[3] == top_trials[0]['trial_id']
+
+      job_requests = [path for path in api.requests if '/jobs/' in path]
+      discovery_requests = len(api.requests) - len(job_requests)
+      # Finished jobs are fetched once, running jobs on every call
+      assert len(job_requests) == 2 + 3, api.requests
+      assert discovery_requests == 1, api.requests
+      print('{} jobs with {} trials ranked correctly, {} requests'.format(
+          len(jobs), num_trials, len(api.requests)))
+  finally:
+    shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+  fire.Fire()
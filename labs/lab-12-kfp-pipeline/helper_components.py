@@ -15,83 +15,371 @@
 from typing import NamedTuple
 
 
+def export_splits(
+    query: str,
+    output_dir: str,
+    project_id: str = '',
+    dataset_location: str = 'US',
+    training_lots: str = '1,2,3,4',
+    validation_lots: str = '8',
+    testing_lots: str = '9',
+    lot_column: str = 'lot',
+    sqlite_db_path: str = '',
+    page_size: int = 100000
+) -> NamedTuple('Outputs', [('training_gcs_path', str),
+                            ('validation_gcs_path', str),
+                            ('testing_gcs_path', str)]):
+  """Exports the training, validation and testing splits from a single query.
+
+  The query returns the rows of all the splits with their lot ids in the
+  lot_column. It runs once, so the source table is scanned only once, and its
+  result is read in one pass: every page is split by lot and appended to the
+  CSV files of the splits, output_dir/datasets/<split>/data.csv. GCS files are
+  uploaded as parallel composite parts, so they have no size limit. The
+  result is read with the BigQuery Storage API when its client library is
+  installed.
+
+  If sqlite_db_path is set, the query runs against the local SQLite database
+  instead of BigQuery, with the source table stored under its BigQuery name.
+  TO_JSON_STRING(<table alias>) is expanded to the columns of the table, and
+  a FARM_FINGERPRINT function is registered for the local queries. It is a
+  SHA-256 based stand-in, so the local lots differ from the lots computed by
+  BigQuery.
+  """
+  import collections
+  import hashlib
+  import json
+  import re
+  import time
+  import pandas as pd
+  import storage
+
+  splits = {
+      'training': training_lots,
+      'validation': validation_lots,
+      'testing': testing_lots
+  }
+  splits = {name: [int(lot) for lot in lots.split(',')]
+            for name, lots in splits.items()}
+
+  def read_bigquery_pages():
+    from google.cloud import bigquery
+    try:
+      from google.cloud import bigquery_storage
+      bqstorage_client = bigquery_storage.BigQueryReadClient()
+    except ImportError:
+      bqstorage_client = None
+
+    client = bigquery.Client(project=project_id or None)
+    query_job = client.query(query, location=dataset_location)
+    rows = query_job.result(page_size=page_size)
+    for page in rows.to_dataframe_iterable(bqstorage_client=bqstorage_client):
+      yield page
+    print('Bytes processed: {}'.format(query_job.total_bytes_processed))
+
+  def read_sqlite_pages():
+    import sqlite3
+
+    def farm_fingerprint(value):
+      digest = hashlib.sha256(str(value).encode('utf-8')).digest()
+      return int.from_bytes(digest[:8], 'little', signed=True) >> 1
+
+    def to_json_string(*names_and_values):
+      row = collections.OrderedDict(
+          zip(names_and_values[::2], names_and_values[1::2]))
+      return json.dumps(row, separators=(',', ':'))
+
+    def mod(dividend, divisor):
+      remainder = abs(dividend) % abs(divisor)
+      return remainder if dividend >= 0 else -remainder
+
+    connection = sqlite3.connect(sqlite_db_path)
+    connection.create_function('FARM_FINGERPRINT', 1, farm_fingerprint)
+    connection.create_function('TO_JSON_STRING', -1, to_json_string)
+    connection.create_function('MOD', 2, mod)
+    try:
+      local_query = query
+      for table, alias in re.findall(r'FROM\s+`([^`]+)`\s+(?:AS\s+)?(\w+)',
+                                     query, flags=re.IGNORECASE):
+        cursor = connection.execute('SELECT * FROM `{}` LIMIT 0'.format(table))
+        columns = ', '.join("'{0}', {1}.`{0}`".format(column[0], alias)
+                            for column in cursor.description)
+        local_query = re.sub(r'TO_JSON_STRING\(\s*{}\s*\)'.format(alias),
+                             'TO_JSON_STRING({})'.format(columns), local_query)
+      cursor = connection.execute(local_query)
+      columns = [column[0] for column in cursor.description]
+      while True:
+        rows = cursor.fetchmany(page_size)
+        if not rows:
+          break
+        yield pd.DataFrame.from_records(rows, columns=columns)
+    finally:
+      connection.close()
+
+  paths = {name: '{}/datasets/{}/data.csv'.format(output_dir, name)
+           for name in splits}
+  files = {name: storage.open_file(path, 'w') for name, path in paths.items()}
+  row_counts = dict.fromkeys(splits, 0)
+  start_time = time.time()
+  try:
+    header = True
+    pages = read_sqlite_pages() if sqlite_db_path else read_bigquery_pages()
+    for page in pages:
+      lots = page.pop(lot_column)
+      for name, split_lots in splits.items():
+        split = page[lots.isin(split_lots).values]
+        split.to_csv(files[name], header=header, index=False)
+        row_counts[name] += len(split)
+      header = False
+  except Exception:
+    for split_file in files.values():
+      storage.abort(split_file)
+    raise
+  finally:
+    for split_file in files.values():
+      split_file.close()
+
+  print('Exported the splits in {:.1f}s'.format(time.time() - start_time))
+  for name, path in paths.items():
+    print('{}: {} rows in {}'.format(name, row_counts[name], path))
+
+  return (paths['training'], paths['validation'], paths['testing'])
+
+
 def retrieve_best_run(
-    project_id: str, job_id: str
+    project_id: str,
+    job_id: str,
+    top_k: int = 1,
+    cache_dir: str = '/tmp/retrieve_best_run',
+    api_endpoint: str = '',
+    results_path: str = ''
 ) -> NamedTuple('Outputs', [('metric_value', float), ('alpha', float),
-                            ('max_iter', int)]):
-  """Retrieves the parameters of the best Hypertune run."""
+                            ('max_iter', int), ('trial_id', str),
+                            ('top_trials', str)]):
+  """Retrieves the parameters of the best Hypertune run.
 
+  The completed trials are ranked by their final objective value according
+  to the goal of the tuning job, and the top_k trials are returned as a JSON
+  list in top_trials. The discovery document of the AI Platform Training API
+  and the responses for finished jobs are cached in cache_dir, so repeated
+  calls do not fetch them again. api_endpoint overrides the root URL of the
+  API, e.g. to use a local fake server, which is called without credentials
+  if the URL is http://.
+
+  If results_path is set, the trials are read from the sweep_results.json
+  file written by the sweep command of the trainer instead of the job.
+  """
+  import json
+  import os
+  import urllib.request
   from googleapiclient import discovery
-  from googleapiclient import errors
 
-  ml = discovery.build('ml', 'v1')
+  root_url = (api_endpoint or 'https://ml.googleapis.com').rstrip('/') + '/'
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
 
-  job_name = 'projects/{}/jobs/{}'.format(project_id, job_id)
-  request = ml.projects().jobs().get(name=job_name)
+  def cached_json(filename, fetch, is_final=lambda value: True):
+    """Returns the cached JSON value, fetching and caching it if missing."""
+    path = os.path.join(cache_dir, filename)
+    if os.path.exists(path):
+      with open(path) as cache_file:
+        return json.load(cache_file)
+    value = fetch()
+    if is_final(value):
+      with open(path + '.tmp', 'w') as cache_file:
+        json.dump(value, cache_file)
+      os.replace(path + '.tmp', path)
+    return value
 
-  try:
-    response = request.execute()
-  except errors.HttpError as err:
-    print(err)
-  except:
-    print('Unexpected error')
+  def fetch_discovery_document():
+    url = root_url + '$discovery/rest?version=v1'
+    with urllib.request.urlopen(url) as response:
+      return json.loads(response.read().decode('utf-8'))
 
-  print(response)
+  def fetch_job():
+    document = cached_json('ml-v1-discovery.json', fetch_discovery_document)
+    document['rootUrl'] = root_url
+    if root_url.startswith('http://'):
+      import httplib2
+      ml = discovery.build_from_document(document, http=httplib2.Http())
+    else:
+      ml = discovery.build_from_document(document)
+    job_name = 'projects/{}/jobs/{}'.format(project_id, job_id)
+    return ml.projects().jobs().get(name=job_name).execute()
+
+  if results_path:
+    import storage
+    with storage.open_file(results_path, 'r') as results_file:
+      results = json.load(results_file)
+    goal = results.get('goal', 'MAXIMIZE')
+    trials = results['trials']
+  else:
+    job = cached_json(
+        'job-{}-{}.json'.format(project_id, job_id), fetch_job,
+        lambda job: job.get('state') in ('SUCCEEDED', 'FAILED', 'CANCELLED'))
+    goal = job['trainingInput']['hyperparameters'].get('goal', 'MAXIMIZE')
+    trials = job.get('trainingOutput', {}).get('trials', [])
 
-  best_trial = response['trainingOutput']['trials'][0]
+  trials = [
+      trial for trial in trials
+      if 'objectiveValue' in trial.get('finalMetric', {})
+  ]
+  if not trials:
+    raise RuntimeError('Job {} has no completed trials'.format(job_id))
+  trials.sort(key=lambda trial: float(trial['finalMetric']['objectiveValue']),
+              reverse=goal == 'MAXIMIZE')
 
-  metric_value = best_trial['finalMetric']['objectiveValue']
+  top_trials = [{
+      'trial_id': trial['trialId'],
+      'objective_value': float(trial['finalMetric']['objectiveValue']),
+      'hyperparameters': trial['hyperparameters'],
+  } for trial in trials[:max(top_k, 1)]]
+  print('{} of {} trials, goal {}:'.format(len(top_trials), len(trials), goal))
+  for trial in top_trials:
+    print(trial)
+
+  best_trial = top_trials[0]
+  metric_value = best_trial['objective_value']
   alpha = float(best_trial['hyperparameters']['alpha'])
   max_iter = int(best_trial['hyperparameters']['max_iter'])
 
-  return (metric_value, alpha, max_iter)
+  return (metric_value, alpha, max_iter, best_trial['trial_id'],
+          json.dumps(top_trials))
 
 
 def evaluate_model(
-    dataset_path: str, model_path: str, metric_name: str
+    dataset_path: str,
+    model_path: str,
+    metric_name: str,
+    metric_names: str = 'accuracy,recall_macro,recall_micro,precision_macro,'
+    'precision_micro,f1_macro,f1_micro,log_loss,top_k_accuracy',
+    top_k: int = 2,
+    chunk_size: int = 100000
 ) -> NamedTuple('Outputs', [('metric_name', str), ('metric_value', float),
                             ('mlpipeline_metrics', 'Metrics')]):
-  """Evaluates a trained sklearn model."""
-  #import joblib
+  """Evaluates a trained sklearn model.
+
+  All metrics in the comma separated metric_names list are computed from a
+  single prediction pass and exported as pipeline metrics. metric_name selects
+  the metric returned for gating the deployment. The testing split is read
+  and scored in chunks of chunk_size rows. The metrics are computed from a
+  running confusion matrix and running log-loss and top-k sums, so the memory
+  used does not depend on the size of the split. Both dataset_path and
+  model_path can be GCS or local paths. A model.joblib export is preferred
+  over model.pkl and its arrays are memory-mapped instead of copied. The
+  model is read with the storage module installed in the base image.
+  """
+  import joblib
   import pickle
   import json
+  import numpy as np
   import pandas as pd
-  import subprocess
-  import sys
+  import storage
 
-  from sklearn.metrics import accuracy_score, recall_score
+  # Aliases kept for compatibility with the single metric names
+  aliases = {'recall': 'recall_macro', 'precision': 'precision_macro',
+             'f1': 'f1_macro'}
+  metric_names = [name.strip() for name in metric_names.split(',')]
+  if aliases.get(metric_name, metric_name) not in [
+      aliases.get(name, name) for name in metric_names]:
+    metric_names.append(metric_name)
 
-  df_test = pd.read_csv(dataset_path)
+  # Memory-map the joblib export if there is one, otherwise stream the pickle
+  model_filepath = '{}/{}'.format(model_path, 'model.joblib')
+  if storage.exists(model_filepath):
+    print(model_filepath)
+    if model_filepath.startswith('gs://'):
+      storage.copy(model_filepath, 'model.joblib')
+      model_filepath = 'model.joblib'
+    model = joblib.load(model_filepath, mmap_mode='r')
+  else:
+    model_filepath = '{}/{}'.format(model_path, 'model.pkl')
+    print(model_filepath)
+    with storage.open_file(model_filepath, 'rb') as model_file:
+      model = pickle.load(model_file)
 
-  X_test = df_test.drop('Cover_Type', axis=1)
-  y_test = df_test['Cover_Type']
+  classes = model.classes_
+  num_classes = len(classes)
+  top_k = min(top_k, num_classes)
+  confusion_matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+  num_examples = 0
+  num_unknown = 0
+  top_k_correct = 0
+  log_loss_sum = 0.0
+  epsilon = 1e-15
 
-  # Copy the model from GCS
-  model_filename = 'model.pkl'
-  gcs_model_filepath = '{}/{}'.format(model_path, model_filename)
-  print(gcs_model_filepath)
-  subprocess.check_call(['gsutil', 'cp', gcs_model_filepath, model_filename],
-                        stderr=sys.stdout)
+  for df_test in pd.read_csv(dataset_path, chunksize=chunk_size):
+    X_test = df_test.drop('Cover_Type', axis=1)
+    y_test = df_test['Cover_Type'].values
 
-  with open(model_filename, 'rb') as model_file:
-    model = pickle.load(model_file)
+    probabilities = model.predict_proba(X_test)
+    predicted = np.argmax(probabilities, axis=1)
 
-  y_hat = model.predict(X_test)
+    # Labels missing from the model's classes count as misclassified
+    actual = np.minimum(np.searchsorted(classes, y_test), num_classes - 1)
+    known = classes[actual] == y_test
+    np.add.at(confusion_matrix, (actual[known], predicted[known]), 1)
+    num_unknown += np.count_nonzero(~known)
 
-  if metric_name == 'accuracy':
-    metric_value = accuracy_score(y_test, y_hat)
-  elif metric_name == 'recall':
-    metric_value = recall_score(y_test, y_hat)
-  else:
-    metric_name = 'N/A'
-    metric_value = 0
+    top_k_predicted = np.argpartition(-probabilities, top_k - 1,
+                                      axis=1)[:, :top_k]
+    top_k_correct += np.count_nonzero(
+        (top_k_predicted == actual[:, np.newaxis]).any(axis=1) & known)
+
+    true_class_probabilities = np.where(
+        known, probabilities[np.arange(len(y_test)), actual], 0)
+    log_loss_sum -= np.log(np.clip(true_class_probabilities, epsilon, 1)).sum()
+    num_examples += len(y_test)
+
+  print('Confusion matrix (rows: actual, columns: predicted):')
+  print(pd.DataFrame(confusion_matrix, index=classes, columns=classes))
+
+  # Per-class metrics are averaged over the classes that occur in the
+  # testing split or in the predictions, with 0 for undefined ratios
+  true_positives = np.diag(confusion_matrix).astype(np.float64)
+  actual_counts = confusion_matrix.sum(axis=1)
+  predicted_counts = confusion_matrix.sum(axis=0)
+  labels = (actual_counts > 0) | (predicted_counts > 0)
+  recalls = np.divide(true_positives, actual_counts,
+                      out=np.zeros(num_classes), where=actual_counts > 0)
+  precisions = np.divide(true_positives, predicted_counts,
+                         out=np.zeros(num_classes), where=predicted_counts > 0)
+  f1_scores = np.divide(2 * precisions * recalls, precisions + recalls,
+                        out=np.zeros(num_classes),
+                        where=(precisions + recalls) > 0)
+  micro_precision = true_positives.sum() / num_examples
+  micro_recall = true_positives.sum() / (actual_counts.sum() + num_unknown)
 
-  # Export the metric
-  metrics = {
-      'metrics': [{
-          'name': metric_name,
-          'numberValue': float(metric_value)
-      }]
+  metric_values = {
+      'accuracy': true_positives.sum() / num_examples,
+      'recall_macro': recalls[labels].mean(),
+      'recall_micro': micro_recall,
+      'precision_macro': precisions[labels].mean(),
+      'precision_micro': micro_precision,
+      'f1_macro': f1_scores[labels].mean(),
+      'f1_micro': 2 * micro_precision * micro_recall /
+                  (micro_precision + micro_recall or 1),
+      'log_loss': log_loss_sum / num_examples,
+      'top_k_accuracy': top_k_correct / num_examples
   }
 
-  return (metric_name, metric_value, json.dumps(metrics))
+  # Export the metrics
+  metrics = {'metrics': []}
+  for name in metric_names:
+    value = metric_values.get(aliases.get(name, name))
+    if value is None:
+      print('Skipping unknown metric: {}'.format(name))
+      continue
+    print('{}: {}'.format(name, value))
+    # Pipeline metric names may only contain lowercase letters, digits and -
+    metrics['metrics'].append({
+        'name': name.replace('top_k', 'top_{}'.format(top_k)).replace('_', '-'),
+        'numberValue': float(value)
+    })
+
+  metric_value = metric_values.get(aliases.get(metric_name, metric_name))
+  if metric_value is None:
+    metric_name = 'N/A'
+    metric_value = 0
+
+  return (metric_name, float(metric_value), json.dumps(metrics))
@@ -0,0 +1,129 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Creates the covertype data splits locally in a single pass."""
+
+import os
+
+import fire
+import numpy as np
+import pandas as pd
+
+# The lots of each split, the same as in the covertype_train pipeline
+SPLITS = {
+    'training': [1, 2, 3, 4],
+    'validation': [8],
+    'testing': [9],
+}
+NUM_LOTS = 10
+SPLIT_FILE_PATH = 'datasets/{}/data.csv'
+
+
+def read_chunks(source_path, chunk_size=100000):
+  """Yields DataFrame chunks of a CSV or a Parquet file."""
+
+  if source_path.endswith('.parquet'):
+    import pyarrow.parquet as pq  # pylint: disable=g-import-not-at-top
+    parquet_file = pq.ParquetFile(source_path)
+    for row_group in range(parquet_file.num_row_groups):
+      yield parquet_file.read_row_group(row_group).to_pandas()
+  else:
+    for chunk in pd.read_csv(source_path, chunksize=chunk_size):
+      yield chunk
+
+
+def _canonical_hashes(values):
+  """Hashes the values of a column in a form that does not depend on dtype.
+
+  Integers are hashed as int64 and floats as float64, except integral floats,
+  which are hashed as the equal int64. A value therefore hashes the same
+  whether its column was read as integers or as floats, e.g. because another
+  value of the chunk is missing.
+  """
+
+  if values.dtype.kind in 'iub':
+    return pd.util.hash_array(values.astype(np.int64))
+  if values.dtype.kind != 'f':
+    return pd.util.hash_array(values)
+
+  values = values.astype(np.float64)
+  hashes = pd.util.hash_array(values)
+  with np.errstate(invalid='ignore'):
+    integral = (np.abs(values) < 2.0**63) & (values == np.floor(values))
+  hashes[integral] = pd.util.hash_array(values[integral].astype(np.int64))
+  return hashes
+
+
+def assign_lots(df, num_lots=NUM_LOTS):
+  """Assigns each row to a lot with a vectorized hash of the row values.
+
+  The values are hashed in a canonical form, see _canonical_hashes, so the
+  lots do not depend on the dtypes inferred from a particular chunk or file
+  format. The lots are stable across runs, but they are not the lots
+  computed by FARM_FINGERPRINT in BigQuery.
+  """
+
+  column_hashes = pd.DataFrame({
+      position: _canonical_hashes(df[column].values)
+      for position, column in enumerate(df.columns)
+  })
+  hashes = pd.util.hash_pandas_object(column_hashes, index=False).values
+  return (hashes % np.uint64(num_lots)).astype(np.int64)
+
+
+def split_dataset(source_path, output_dir, num_lots=NUM_LOTS, splits=None,
+                  chunk_size=100000):
+  """Writes all the splits of a dataset from a single pass over it.
+
+  Args:
+    source_path: A CSV or a Parquet file.
+    output_dir: The directory that receives the datasets/<split>/data.csv
+      files, the same layout the pipeline uses in its artifact store.
+    num_lots: The number of lots the rows are hashed into.
+    splits: A dictionary mapping the split names to their lots. Defaults to
+      the splits of the covertype_train pipeline.
+    chunk_size: The number of CSV rows read at a time.
+
+  Returns:
+    A dictionary mapping the split names to their file paths.
+  """
+
+  splits = splits or SPLITS
+  paths = {name: os.path.join(output_dir, SPLIT_FILE_PATH.format(name))
+           for name in splits}
+  files = {}
+  row_counts = dict.fromkeys(splits, 0)
+  try:
+    for name, path in paths.items():
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      files[name] = open(path, 'w')
+
+    header = True
+    for chunk in read_chunks(source_path, chunk_size):
+      lots = assign_lots(chunk, num_lots)
+      for name, split_lots in splits.items():
+        split = chunk[np.isin(lots, split_lots)]
+        split.to_csv(files[name], header=header, index=False)
+        row_counts[name] += len(split)
+      header = False
+  finally:
+    for split_file in files.values():
+      split_file.close()
+
+  for name, path in paths.items():
+    print('{}: {} rows in {}'.format(name, row_counts[name], path))
+  return paths
+
+
+if __name__ == '__main__':
+  fire.Fire(split_dataset)
@@ -13,60 +13,443 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ast
+import concurrent.futures
+import itertools
+import json
 import os
-import subprocess
+import shutil
 import sys
+import tempfile
 
 import fire
+import joblib
 import pickle
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
 import hypertune
+import storage
 
 from sklearn.compose import ColumnTransformer
 from sklearn.linear_model import SGDClassifier
 from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import StandardScaler, OneHotEncoder
+from sklearn.preprocessing import StandardScaler, OneHotEncoder, OrdinalEncoder
 
+NUMERIC_FEATURE_INDEXES = slice(0, 10)
+CATEGORICAL_FEATURE_INDEXES = slice(10, 12)
+LABEL_COLUMN = 'Cover_Type'
+DATASET_CACHE_DIR = '/tmp/dataset_cache'
+FEATURE_LAYOUTS = ('csr', 'dense', 'codes')
+MODEL_FILENAMES = {'pickle': 'model.pkl', 'joblib': 'model.joblib'}
+SWEEP_RESULTS_FILENAME = 'sweep_results.json'
 
-def train_evaluate(job_dir, training_dataset_path, validation_dataset_path, alpha, max_iter, hptune):
-    
-  df_train = pd.read_csv(training_dataset_path)
-  df_validation = pd.read_csv(validation_dataset_path)
-    
-  if not hptune:
-    df_train = pd.concat([df_train, df_validation])
 
-  numeric_feature_indexes = slice(0, 10)
-  categorical_feature_indexes = slice(10, 12)
+def _local_copy(path, cache_dir):
+  """Returns a local path to the file, downloading it from GCS if needed."""
+
+  if not path.startswith('gs://'):
+    return path
+
+  download_dir = os.path.join(cache_dir, 'downloads')
+  os.makedirs(download_dir, exist_ok=True)
+  local_path = os.path.join(download_dir,
+                            path[len('gs://'):].replace('/', '_'))
+  storage.copy(path, local_path)
+  return local_path
+
+
+def _write_dataset_cache(csv_path, cache_path):
+  """Converts a CSV split into a bundle of memory-mappable .npy files."""
+
+  df = pd.read_csv(csv_path)
+  numeric_columns = list(df.columns[NUMERIC_FEATURE_INDEXES])
+  categorical_columns = list(df.columns[CATEGORICAL_FEATURE_INDEXES])
+
+  # Write to a private directory and publish it with an atomic rename so that
+  # concurrent trials never read a partially written bundle.
+  tmp_path = '{}.tmp-{}'.format(cache_path, os.getpid())
+  os.makedirs(tmp_path)
+
+  np.save(os.path.join(tmp_path, 'numeric.npy'),
+          np.ascontiguousarray(df[numeric_columns].values, dtype=np.float64))
+  categories = {}
+  for column in categorical_columns:
+    # Saved with the integer width pandas uses for the codes, so that
+    # Categorical.from_codes does not copy them when they are loaded
+    categorical = pd.Categorical(df[column])
+    np.save(os.path.join(tmp_path, '{}.npy'.format(column)),
+            categorical.codes)
+    categories[column] = categorical.categories.tolist()
+  np.save(os.path.join(tmp_path, 'label.npy'), df[LABEL_COLUMN].values)
+
+  metadata = {
+      'columns': list(df.columns),
+      'numeric_columns': numeric_columns,
+      'categories': categories
+  }
+  with open(os.path.join(tmp_path, 'metadata.json'), 'w') as metadata_file:
+    json.dump(metadata, metadata_file)
+
+  try:
+    os.rename(tmp_path, cache_path)
+  except OSError:
+    # Another trial has already published the same content.
+    shutil.rmtree(tmp_path)
+
+
+def _read_dataset_cache(cache_path):
+  """Loads a cached split as a DataFrame backed by memory-mapped arrays."""
+
+  with open(os.path.join(cache_path, 'metadata.json')) as metadata_file:
+    metadata = json.load(metadata_file)
+
+  # The numeric columns are contiguous in the CSV file, so the split is put
+  # together from the memory-mapped arrays in column order without copies.
+  pieces = [pd.DataFrame(
+      np.load(os.path.join(cache_path, 'numeric.npy'), mmap_mode='r'),
+      columns=metadata['numeric_columns'], copy=False)]
+  for column, categories in metadata['categories'].items():
+    codes = np.load(os.path.join(cache_path, '{}.npy'.format(column)),
+                    mmap_mode='r')
+    pieces.append(pd.Series(pd.Categorical.from_codes(codes, categories),
+                            name=column).to_frame())
+  label = np.load(os.path.join(cache_path, 'label.npy'), mmap_mode='r')
+  pieces.append(pd.DataFrame(label.reshape(-1, 1), columns=[LABEL_COLUMN],
+                             copy=False))
+  pieces.sort(key=lambda piece: metadata['columns'].index(piece.columns[0]))
+
+  return pd.concat(pieces, axis=1, copy=False)
 
-  preprocessor = ColumnTransformer(
+
+def load_dataset(dataset_path, cache_dir=None):
+  """Loads a dataset split with the numeric features cast to float64.
+
+  If cache_dir is set, the first call converts the CSV file to a typed,
+  content-addressed bundle in cache_dir and subsequent calls for the same
+  content load the bundle without parsing the CSV file. A GCS split is keyed
+  on its object metadata, so it is only downloaded when it is not cached.
+  """
+
+  if not cache_dir:
+    df = pd.read_csv(dataset_path)
+    num_features_type_map = {
+        feature: 'float64' for feature in df.columns[NUMERIC_FEATURE_INDEXES]}
+    return df.astype(num_features_type_map)
+
+  cache_path = os.path.join(cache_dir, storage.fingerprint(dataset_path))
+  if not os.path.exists(cache_path):
+    print('Caching {} in: {}'.format(dataset_path, cache_path))
+    _write_dataset_cache(_local_copy(dataset_path, cache_dir), cache_path)
+
+  return _read_dataset_cache(cache_path)
+
+
+def build_preprocessor(feature_layout='csr', categories='auto'):
+  """Builds the feature preprocessing transformer.
+
+  Categories that were not seen during fitting are encoded as all zeros in
+  the one-hot layouts, so a fitted preprocessor can transform splits with new
+  categories. The feature_layout controls the matrix the transformer outputs:
+    - csr: scaled numeric and one-hot encoded categorical features in a CSR
+      matrix, the natural input of linear models
+    - dense: the same features in a dense matrix with the numeric features
+      in the leading columns
+    - codes: scaled numeric features followed by one integer category code per
+      categorical feature, for estimators that handle categories natively
+  The categories of the categorical features are learned from the data,
+  unless a list of categories per feature is given.
+  """
+
+  if feature_layout == 'csr':
+    encoder = OneHotEncoder(categories=categories, handle_unknown='ignore',
+                            dtype=np.float32)
+    sparse_threshold = 1.0
+  elif feature_layout == 'dense':
+    encoder = OneHotEncoder(categories=categories, handle_unknown='ignore',
+                            sparse=False, dtype=np.float32)
+    sparse_threshold = 0.0
+  elif feature_layout == 'codes':
+    encoder = OrdinalEncoder(categories=categories, dtype=np.float32)
+    sparse_threshold = 0.0
+  else:
+    raise ValueError('Unknown feature layout: {}. Expected one of: {}'.format(
+        feature_layout, FEATURE_LAYOUTS))
+
+  return ColumnTransformer(
     transformers=[
-        ('num', StandardScaler(), numeric_feature_indexes),
-        ('cat', OneHotEncoder(), categorical_feature_indexes) 
+        ('num', StandardScaler(), NUMERIC_FEATURE_INDEXES),
+        ('cat', encoder, CATEGORICAL_FEATURE_INDEXES) 
+    ],
+    sparse_threshold=sparse_threshold)
+
+
+def to_compact_matrix(matrix, dtype=np.float64):
+  """Converts a transformed feature matrix to the layout the estimators fit on.
+
+  Sparse matrices are returned in the CSR format and dense matrices as
+  C-contiguous arrays, without a copy if the matrix already has the layout.
+  SGDClassifier converts other layouts and dtypes, including float32, to
+  float64 with a copy during the fit, so the default dtype avoids the copy.
+  """
+
+  if scipy.sparse.issparse(matrix):
+    return matrix.tocsr().astype(dtype, copy=False)
+  return np.ascontiguousarray(matrix, dtype=dtype)
+
+
+def _fixed_width_categories(model):
+  """Converts the string categories of the fitted encoders to fixed-width arrays.
+
+  joblib memory-maps fixed-width arrays, while object arrays go through its
+  pure-Python unpickler, which dominates the load time of large vocabularies.
+  """
+
+  for _, transformer, _ in model.named_steps['preprocessor'].transformers_:
+    if hasattr(transformer, 'categories_'):
+      transformer.categories_ = [
+          categories.astype(str) if categories.dtype == object and all(
+              isinstance(category, str) for category in categories)
+          else categories for categories in transformer.categories_]
+
+
+def save_model(model, job_dir, model_format='pickle'):
+  """Streams a model to job_dir and returns its path.
+
+  The joblib format stores the NumPy arrays of the model uncompressed, so
+  load_model can memory-map them instead of reading them. The encoder
+  categories of the model are converted in place for this format.
+  """
+
+  if model_format not in MODEL_FILENAMES:
+    raise ValueError('Unsupported model format: {}'.format(model_format))
+
+  model_path = "{}/{}".format(job_dir, MODEL_FILENAMES[model_format])
+  with storage.open_file(model_path, 'wb') as model_file:
+    if model_format == 'joblib':
+      _fixed_width_categories(model)
+      joblib.dump(model, model_file)
+    else:
+      pickle.dump(model, model_file, protocol=pickle.HIGHEST_PROTOCOL)
+  return model_path
+
+
+def load_model(model_dir, cache_dir=DATASET_CACHE_DIR, mmap_mode='r'):
+  """Loads a model saved by save_model, preferring the joblib format.
+
+  The arrays of a joblib model are memory-mapped with mmap_mode. joblib can
+  only map local files, so a model on GCS is first copied to cache_dir. Use
+  mmap_mode='c' for a model that is updated after loading.
+  """
+
+  for model_format in ('joblib', 'pickle'):
+    model_path = "{}/{}".format(model_dir, MODEL_FILENAMES[model_format])
+    if not storage.exists(model_path):
+      continue
+    if model_format == 'joblib':
+      return joblib.load(_local_copy(model_path, cache_dir),
+                         mmap_mode=mmap_mode)
+    with storage.open_file(model_path, 'rb') as model_file:
+      return pickle.load(model_file)
+  raise ValueError('No model found in: {}'.format(model_dir))
+
+
+def _trial_dir(job_dir):
+  """Returns the directory of the current hyperparameter tuning trial."""
+
+  trial_id = os.environ.get('CLOUD_ML_TRIAL_ID')
+  return "{}/{}".format(job_dir, trial_id) if trial_id else job_dir
+
+
+def read_chunks(dataset_paths, chunk_size):
+  """Yields DataFrame chunks of the splits with the numeric features as float64.
+
+  The splits are streamed from GCS or local files, and only one chunk of
+  chunk_size rows is held in memory at a time.
+  """
+
+  for dataset_path in dataset_paths:
+    with storage.open_file(dataset_path, 'r') as dataset_file:
+      for chunk in pd.read_csv(dataset_file, chunksize=chunk_size):
+        yield chunk.astype({feature: 'float64' for feature
+                            in chunk.columns[NUMERIC_FEATURE_INDEXES]})
+
+
+def fit_preprocessor_streaming(dataset_paths, feature_layout='csr',
+                               chunk_size=100000):
+  """Fits the preprocessor with a single pass over the chunks of the splits.
+
+  The scaler statistics are accumulated with StandardScaler.partial_fit and
+  the sorted categories of the categorical features are collected, which
+  gives the same preprocessor as fitting it on the concatenated splits.
+  Returns the fitted preprocessor and the sorted labels.
+  """
+
+  scaler = StandardScaler()
+  categories = None
+  labels = set()
+  sample = None
+  for chunk in read_chunks(dataset_paths, chunk_size):
+    features = chunk.drop(LABEL_COLUMN, axis=1)
+    scaler.partial_fit(features.iloc[:, NUMERIC_FEATURE_INDEXES])
+    categorical = features.iloc[:, CATEGORICAL_FEATURE_INDEXES]
+    if categories is None:
+      categories = [set() for _ in categorical.columns]
+    for values, column in zip(categories, categorical.columns):
+      values.update(categorical[column].dropna().unique())
+    labels.update(chunk[LABEL_COLUMN].unique())
+    if sample is None:
+      sample = features.iloc[:1]
+
+  preprocessor = build_preprocessor(
+      feature_layout, [sorted(values) for values in categories])
+  # Fits the encoder with the collected categories, then replaces the scaler
+  # fitted on the sample row with the statistics of all the chunks.
+  preprocessor.fit(sample)
+  fitted_scaler = preprocessor.named_transformers_['num']
+  for attribute in ('mean_', 'var_', 'scale_', 'n_samples_seen_'):
+    setattr(fitted_scaler, attribute, getattr(scaler, attribute))
+  return preprocessor, np.array(sorted(labels))
+
+
+def partial_fit_streaming(classifier, preprocessor, dataset_paths, classes,
+                          epochs, chunk_size=100000, seed=None):
+  """Fits a classifier with partial_fit over shuffled epochs of chunks.
+
+  The chunks are transformed once and stored in a temporary directory. Each
+  epoch visits the stored chunks in a random order and shuffles the rows of
+  every chunk, so memory is bounded by the chunk size.
+  """
+
+  rng = np.random.RandomState(seed)
+  with tempfile.TemporaryDirectory() as chunk_dir:
+    chunk_paths = []
+    for chunk in read_chunks(dataset_paths, chunk_size):
+      chunk_path = os.path.join(chunk_dir, '{:05d}.joblib'.format(
+          len(chunk_paths)))
+      joblib.dump((to_compact_matrix(preprocessor.transform(
+          chunk.drop(LABEL_COLUMN, axis=1))), chunk[LABEL_COLUMN].values),
+                  chunk_path)
+      chunk_paths.append(chunk_path)
+
+    for _ in range(epochs):
+      for index in rng.permutation(len(chunk_paths)):
+        X, y = joblib.load(chunk_paths[index])
+        order = rng.permutation(len(y))
+        classifier.partial_fit(X[order], y[order], classes=classes)
+  return classifier
+
+
+def score_streaming(pipeline, dataset_path, chunk_size=100000):
+  """Computes the accuracy of a pipeline on a split, one chunk at a time."""
+
+  correct = total = 0
+  for chunk in read_chunks([dataset_path], chunk_size):
+    predictions = pipeline.predict(chunk.drop(LABEL_COLUMN, axis=1))
+    correct += np.sum(predictions == chunk[LABEL_COLUMN].values)
+    total += len(chunk)
+  return correct / total
+
+
+def train_streaming(dataset_paths, alpha, feature_layout='csr',
+                    chunk_size=100000, epochs=5, warm_start_dir='',
+                    warm_start_epochs=1, seed=None):
+  """Trains the model without loading the splits in memory.
+
+  A first pass over the chunks fits the preprocessor and the classifier is
+  then trained for a fixed number of epochs with partial_fit. A warm start
+  reuses the preprocessor of a saved trial instead, and trains its
+  classifier for warm_start_epochs.
+  """
+
+  if warm_start_dir:
+    print('Warm-starting from: {}'.format(warm_start_dir))
+    pipeline = load_model(warm_start_dir, mmap_mode='c')
+    pipeline.set_params(classifier__alpha=alpha)
+    classes = pipeline.named_steps['classifier'].classes_
+    epochs = warm_start_epochs
+  else:
+    preprocessor, classes = fit_preprocessor_streaming(
+        dataset_paths, feature_layout, chunk_size)
+    pipeline = Pipeline([
+      ('preprocessor', preprocessor),
+      ('classifier', SGDClassifier(loss='log', alpha=alpha))
     ])
 
-  pipeline = Pipeline([
-    ('preprocessor', preprocessor),
-    ('classifier', SGDClassifier(loss='log'))
-  ])
-    
-  num_features_type_map = {feature: 'float64' for feature in df_train.columns[numeric_feature_indexes]}
-  df_train = df_train.astype(num_features_type_map)
-  df_validation = df_validation.astype(num_features_type_map) 
-
-  print('Starting training: alpha={}, max_iter={}'.format(alpha, max_iter))
-  X_train = df_train.drop('Cover_Type', axis=1)
-  y_train = df_train['Cover_Type']
-  
-  pipeline.set_params(classifier__alpha=alpha, classifier__max_iter=max_iter)
-  pipeline.fit(X_train, y_train)
+  print('Starting streaming training: alpha={}, epochs={}'.format(
+      alpha, epochs))
+  partial_fit_streaming(pipeline.named_steps['classifier'],
+                        pipeline.named_steps['preprocessor'], dataset_paths,
+                        classes, epochs, chunk_size, seed)
+  return pipeline
+
+
+def train_evaluate(job_dir, training_dataset_path, validation_dataset_path, alpha, max_iter, hptune,
+                   cache_dir=DATASET_CACHE_DIR, feature_layout='csr',
+                   model_format='pickle', save_trial=False, warm_start_dir='',
+                   warm_start_epochs=1, streaming=False, chunk_size=100000,
+                   epochs=5):
+  """Trains and evaluates the model, or trains the final model.
+
+  With hptune, the model is trained on the training split and its validation
+  accuracy is reported to hypertune. If save_trial is set, the fitted
+  pipeline is also saved to job_dir/<trial id>. Otherwise the model is
+  trained on the training and validation splits and saved to job_dir. If
+  warm_start_dir holds a saved trial, the final model starts from it: the
+  trial's fitted preprocessor is reused and its classifier is updated with
+  warm_start_epochs passes of partial_fit instead of fitting from scratch.
+
+  With streaming, the splits are read in chunks of chunk_size rows and the
+  classifier is trained with partial_fit for a fixed number of epochs
+  instead of max_iter, so the memory used does not depend on the size of the
+  splits.
+  """
+
+  if not hptune:
+    training_dataset_paths = [training_dataset_path, validation_dataset_path]
+  else:
+    training_dataset_paths = [training_dataset_path]
+    warm_start_dir = ''
+
+  if streaming:
+    pipeline = train_streaming(training_dataset_paths, alpha, feature_layout,
+                               chunk_size, epochs, warm_start_dir,
+                               warm_start_epochs)
+  else:
+    df_train = pd.concat([load_dataset(dataset_path, cache_dir)
+                          for dataset_path in training_dataset_paths])
+    X_train = df_train.drop(LABEL_COLUMN, axis=1)
+    y_train = df_train[LABEL_COLUMN]
+
+    if warm_start_dir:
+      print('Warm-starting from: {}'.format(warm_start_dir))
+      pipeline = load_model(warm_start_dir, cache_dir, mmap_mode='c')
+      pipeline.set_params(classifier__alpha=alpha)
+      X_transformed = to_compact_matrix(
+          pipeline.named_steps['preprocessor'].transform(X_train))
+      for _ in range(warm_start_epochs):
+        pipeline.named_steps['classifier'].partial_fit(X_transformed, y_train)
+    else:
+      pipeline = Pipeline([
+        ('preprocessor', build_preprocessor(feature_layout)),
+        ('classifier', SGDClassifier(loss='log'))
+      ])
+
+      print('Starting training: alpha={}, max_iter={}'.format(alpha, max_iter))
+      pipeline.set_params(classifier__alpha=alpha, classifier__max_iter=max_iter)
+      X_transformed = to_compact_matrix(
+          pipeline.named_steps['preprocessor'].fit_transform(X_train))
+      pipeline.named_steps['classifier'].fit(X_transformed, y_train)
   
   if hptune:
-    X_validation = df_validation.drop('Cover_Type', axis=1)
-    y_validation = df_validation['Cover_Type']
-    accuracy = pipeline.score(X_validation, y_validation)
+    if streaming:
+      accuracy = score_streaming(pipeline, validation_dataset_path, chunk_size)
+    else:
+      df_validation = load_dataset(validation_dataset_path, cache_dir)
+      X_validation = df_validation.drop(LABEL_COLUMN, axis=1)
+      y_validation = df_validation[LABEL_COLUMN]
+      accuracy = pipeline.score(X_validation, y_validation)
     print('Model accuracy: {}'.format(accuracy))
     # Log it with hypertune
     hpt = hypertune.HyperTune()
@@ -74,15 +457,172 @@ def train_evaluate(job_dir, training_dataset_path, validation_dataset_path, alph
       hyperparameter_metric_tag='accuracy',
       metric_value=accuracy
     )
+    if save_trial:
+      model_path = save_model(pipeline, _trial_dir(job_dir), model_format)
+      print("Saved trial model in: {}".format(model_path))
 
   # Save the model
   if not hptune:
-    model_filename = 'model.pkl'
-    with open(model_filename, 'wb') as model_file:
-        pickle.dump(pipeline, model_file)
-    gcs_model_path = "{}/{}".format(job_dir, model_filename)
-    subprocess.check_call(['gsutil', 'cp', model_filename, gcs_model_path], stderr=sys.stdout)
-    print("Saved model in: {}".format(gcs_model_path)) 
-    
+    model_path = save_model(pipeline, job_dir, model_format)
+    print("Saved model in: {}".format(model_path)) 
+
+
+def _parameter_values(parameter):
+  """Returns the grid values of a hyperparameter."""
+
+  if parameter['type'] == 'DISCRETE':
+    return parameter['discreteValues']
+  if parameter['type'] == 'CATEGORICAL':
+    return parameter['categoricalValues']
+  if parameter['type'] == 'INTEGER':
+    return list(range(parameter['minValue'], parameter['maxValue'] + 1))
+  raise ValueError('Parameter {} of type {} cannot be used in a grid search'.format(
+      parameter['parameterName'], parameter['type']))
+
+
+def _sample_parameter(parameter, rng):
+  """Samples a random value of a hyperparameter."""
+
+  if parameter['type'] == 'DOUBLE':
+    min_value, max_value = parameter['minValue'], parameter['maxValue']
+    if parameter.get('scaleType') in ('UNIT_LOG_SCALE', 'UNIT_REVERSE_LOG_SCALE'):
+      return float(np.exp(rng.uniform(np.log(min_value), np.log(max_value))))
+    return float(rng.uniform(min_value, max_value))
+  if parameter['type'] == 'INTEGER':
+    return int(rng.randint(parameter['minValue'], parameter['maxValue'] + 1))
+  return rng.choice(_parameter_values(parameter)).item()
+
+
+def expand_search_space(hyperparameters, seed=None):
+  """Expands an AI Platform hyperparameter spec into a list of trials.
+
+  Specs with only DISCRETE and CATEGORICAL parameters, or with the GRID_SEARCH
+  algorithm, are expanded into a full grid. Other specs are sampled randomly.
+  Both are capped at maxTrials.
+  """
+
+  parameters = hyperparameters['params']
+  names = [parameter['parameterName'] for parameter in parameters]
+  max_trials = hyperparameters.get('maxTrials')
+
+  if (hyperparameters.get('algorithm') == 'GRID_SEARCH' or
+      all(parameter['type'] in ('DISCRETE', 'CATEGORICAL')
+          for parameter in parameters)):
+    trials = [dict(zip(names, values)) for values in itertools.product(
+        *[_parameter_values(parameter) for parameter in parameters])]
+    return trials[:max_trials]
+
+  rng = np.random.RandomState(seed)
+  return [{parameter['parameterName']: _sample_parameter(parameter, rng)
+           for parameter in parameters}
+          for _ in range(max_trials or 10)]
+
+
+_sweep_data = None
+
+
+def _init_sweep_worker(X_train, y_train, X_validation, y_validation):
+  """Makes the transformed datasets available to a sweep worker process."""
+
+  global _sweep_data
+  _sweep_data = (X_train, y_train, X_validation, y_validation)
+
+
+def _evaluate_trial(params):
+  """Fits a classifier with the trial's parameters on the transformed data.
+
+  Returns the validation accuracy and the fitted classifier.
+  """
+
+  X_train, y_train, X_validation, y_validation = _sweep_data
+  classifier = SGDClassifier(loss='log', **params)
+  classifier.fit(X_train, y_train)
+  return classifier.score(X_validation, y_validation), classifier
+
+
+def sweep(job_dir, training_dataset_path, validation_dataset_path, search_spec,
+          n_jobs=None, seed=None, cache_dir=DATASET_CACHE_DIR,
+          feature_layout='csr', model_format='pickle'):
+  """Runs all trials of a hyperparameter search in a single invocation.
+
+  The datasets are loaded and preprocessed once and every trial fits only the
+  classifier. search_spec uses the same format as the hypertune settings
+  passed to AI Platform Training. The trials are saved to
+  job_dir/sweep_results.json in the format of the trainingOutput of an AI
+  Platform hyperparameter tuning job, which retrieve_best_run reads, and the
+  fitted pipeline of the best trial is saved to job_dir/<trial id>.
+  """
+
+  if isinstance(search_spec, str):
+    try:
+      search_spec = json.loads(search_spec)
+    except ValueError:
+      # The pipeline's default settings are a Python literal
+      search_spec = ast.literal_eval(search_spec)
+  hyperparameters = search_spec.get('hyperparameters', search_spec)
+  metric_tag = hyperparameters.get('hyperparameterMetricTag', 'accuracy')
+  trials = expand_search_space(hyperparameters, seed)
+
+  df_train = load_dataset(training_dataset_path, cache_dir)
+  df_validation = load_dataset(validation_dataset_path, cache_dir)
+
+  preprocessor = build_preprocessor(feature_layout)
+  X_train = to_compact_matrix(
+      preprocessor.fit_transform(df_train.drop(LABEL_COLUMN, axis=1)))
+  X_validation = to_compact_matrix(
+      preprocessor.transform(df_validation.drop(LABEL_COLUMN, axis=1)))
+  y_train = df_train[LABEL_COLUMN].values
+  y_validation = df_validation[LABEL_COLUMN].values
+
+  print('Starting sweep: {} trials'.format(len(trials)))
+  with concurrent.futures.ProcessPoolExecutor(
+      max_workers=n_jobs,
+      initializer=_init_sweep_worker,
+      initargs=(X_train, y_train, X_validation, y_validation)) as executor:
+    outcomes = list(executor.map(_evaluate_trial, trials))
+  accuracies = [accuracy for accuracy, _ in outcomes]
+
+  hpt = hypertune.HyperTune()
+  results = []
+  for trial_id, (params, accuracy) in enumerate(zip(trials, accuracies), 1):
+    print('Trial {}: {}, accuracy={}'.format(trial_id, params, accuracy))
+    hpt.report_hyperparameter_tuning_metric(
+      hyperparameter_metric_tag=metric_tag,
+      metric_value=accuracy,
+      global_step=trial_id
+    )
+    results.append({
+        'trialId': str(trial_id),
+        'hyperparameters': {name: str(value) for name, value in params.items()},
+        'finalMetric': {'trainingStep': '1', 'objectiveValue': accuracy}
+    })
+
+  # Order the trials the same way AI Platform does, best trial first
+  goal = hyperparameters.get('goal', 'MAXIMIZE')
+  results.sort(key=lambda trial: trial['finalMetric']['objectiveValue'],
+               reverse=goal == 'MAXIMIZE')
+
+  best_trial_id = results[0]['trialId']
+  pipeline = Pipeline([
+      ('preprocessor', preprocessor),
+      ('classifier', outcomes[int(best_trial_id) - 1][1])
+  ])
+  model_path = save_model(pipeline, "{}/{}".format(job_dir, best_trial_id),
+                          model_format)
+  print("Saved the model of trial {} in: {}".format(best_trial_id, model_path))
+
+  results_path = "{}/{}".format(job_dir, SWEEP_RESULTS_FILENAME)
+  with storage.open_file(results_path, 'w') as results_file:
+    json.dump({
+        'hyperparameterMetricTag': metric_tag,
+        'goal': goal,
+        'trials': results
+    }, results_file)
+  print("Saved sweep results in: {}".format(results_path))
+
+
 if __name__ == "__main__":
-  fire.Fire(train_evaluate)
\ No newline at end of file
+  if sys.argv[1:2] == ['sweep']:
+    fire.Fire(sweep, command=sys.argv[2:])
+  else:
+    fire.Fire(train_evaluate)
\ No newline at end of file
@@ -21,7 +21,7 @@ _INVERTING_PROXY_HOST=[YOUR_INVERSE_PROXY],\
 _TRAINER_IMAGE_NAME=trainer_image,\
 _BASE_IMAGE_NAME=base_image,\
 TAG_NAME=test,\
-_PIPELINE_FOLDER=lab-13-kfp-cicd/pipeline,\
+_PIPELINE_FOLDER=labs/lab-13-kfp-cicd/pipeline,\
 _PIPELINE_DSL=covertype_training_pipeline.py,\
 _PIPELINE_PACKAGE=covertype_training_pipeline.yaml,\
 _PIPELINE_NAME=covertype_training_deployment,\
@@ -30,4 +30,4 @@ _PYTHON_VERSION=3.5,\
 _COMPONENT_URL_SEARCH_PREFIX=https://raw.githubusercontent.com/kubeflow/pipelines/0.1.36/components/gcp/
 
 
-gcloud builds submit .. --config cloudbuild.yaml --substitutions $SUBSTITUTIONS
+gcloud builds submit ../.. --config cloudbuild.yaml --substitutions $SUBSTITUTIONS
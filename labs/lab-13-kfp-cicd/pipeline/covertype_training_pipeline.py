@@ -16,8 +16,8 @@
 import os
 
 from helper_components import evaluate_model
+from helper_components import export_splits
 from helper_components import retrieve_best_run
-from jinja2 import Template
 import kfp
 from kfp.components import func_to_container_op
 from kfp.dsl.types import Dict
@@ -26,6 +26,7 @@ from kfp.dsl.types import GCPRegion
 from kfp.dsl.types import GCSPath
 from kfp.dsl.types import String
 from kfp.gcp import use_gcp_secret
+import query_templates
 
 # Defaults and environment settings
 BASE_IMAGE = os.getenv('BASE_IMAGE')
@@ -33,13 +34,15 @@ TRAINER_IMAGE = os.getenv('TRAINER_IMAGE')
 RUNTIME_VERSION = os.getenv('RUNTIME_VERSION')
 PYTHON_VERSION = os.getenv('PYTHON_VERSION')
 COMPONENT_URL_SEARCH_PREFIX = os.getenv('COMPONENT_URL_SEARCH_PREFIX')
-
-TRAINING_FILE_PATH = 'datasets/training/data.csv'
-VALIDATION_FILE_PATH = 'datasets/validation/data.csv'
-TESTING_FILE_PATH = 'datasets/testing/data.csv'
+# 'hypertune' runs an AI Platform hyperparameter tuning job, 'sweep' runs all
+# the trials in a single training job with the sweep command of the trainer
+TUNING_MODE = os.getenv('TUNING_MODE', 'hypertune')
 
 # Parameter defaults
-SPLITS_DATASET_ID = 'splits'
+NUM_LOTS = 10
+TRAINING_LOTS = [1, 2, 3, 4]
+VALIDATION_LOTS = [8]
+TESTING_LOTS = [9]
 HYPERTUNE_SETTINGS = """
 {
     "hyperparameters":  {
@@ -66,20 +69,28 @@ HYPERTUNE_SETTINGS = """
 }
 """
 
-
-# Helper functions
-def generate_sampling_query(source_table_name, num_lots, lots):
-  """Prepares the data sampling query."""
-
-  sampling_query_template = """
-       SELECT *
+SAMPLING_QUERY_TEMPLATE = """
+       SELECT *{% if lot_column %},
+           MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(cover))), {{ num_lots | sql_int }}) AS {{ lot_column | sql_identifier }}{% endif %}
        FROM 
-           `{{ source_table }}` AS cover
+           `{{ source_table | sql_identifier }}` AS cover
        WHERE 
-       MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(cover))), {{ num_lots }}) IN ({{ lots }})
+       MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(cover))), {{ num_lots | sql_int }}) IN ({{ lots | sql_list }})
        """
-  query = Template(sampling_query_template).render(
-      source_table=source_table_name, num_lots=num_lots, lots=str(lots)[1:-1])
+
+
+# Helper functions
+def generate_sampling_query(source_table_name, num_lots, lots,
+                            lot_column=None):
+  """Prepares the data sampling query.
+
+  If lot_column is set, the query also returns the lot id of each row in a
+  column with this name.
+  """
+
+  query = query_templates.render(
+      SAMPLING_QUERY_TEMPLATE, source_table=source_table_name,
+      num_lots=num_lots, lots=lots, lot_column=lot_column)
 
   return query
 
@@ -88,9 +99,9 @@ def generate_sampling_query(source_table_name, num_lots, lots):
 component_store = kfp.components.ComponentStore(
     local_search_paths=None, url_search_prefixes=[COMPONENT_URL_SEARCH_PREFIX])
 
-bigquery_query_op = component_store.load_component('bigquery/query')
 mlengine_train_op = component_store.load_component('ml_engine/train')
 mlengine_deploy_op = component_store.load_component('ml_engine/deploy')
+export_splits_op = func_to_container_op(export_splits, base_image=BASE_IMAGE)
 retrieve_best_run_op = func_to_container_op(
     retrieve_best_run, base_image=BASE_IMAGE)
 evaluate_model_op = func_to_container_op(evaluate_model, base_image=BASE_IMAGE)
@@ -104,7 +115,6 @@ def covertype_train(project_id: GCPProjectID,
                     region: GCPRegion,
                     source_table_name: String,
                     gcs_root: GCSPath,
-                    dataset_id: str,
                     evaluation_metric_name: str,
                     evaluation_metric_threshold: float,
                     model_id: str,
@@ -114,80 +124,81 @@ def covertype_train(project_id: GCPProjectID,
                     dataset_location: str = 'US'):
   """Orchestrates training and deployment of an sklearn model."""
 
-  # Create the training split
+  # Create the training, validation and testing splits with a single scan
   query = generate_sampling_query(
-      source_table_name=source_table_name, num_lots=10, lots=[1, 2, 3, 4])
+      source_table_name=source_table_name,
+      num_lots=NUM_LOTS,
+      lots=TRAINING_LOTS + VALIDATION_LOTS + TESTING_LOTS,
+      lot_column='lot')
 
-  training_file_path = '{}/{}'.format(gcs_root, TRAINING_FILE_PATH)
-
-  create_training_split = bigquery_query_op(
+  create_splits = export_splits_op(
       query=query,
+      output_dir=gcs_root,
       project_id=project_id,
-      dataset_id=dataset_id,
-      table_id='',
-      output_gcs_path=training_file_path,
-      dataset_location=dataset_location)
-
-  # Create the validation split
-  query = generate_sampling_query(
-      source_table_name=source_table_name, num_lots=10, lots=[8])
-
-  validation_file_path = '{}/{}'.format(gcs_root, VALIDATION_FILE_PATH)
-
-  create_validation_split = bigquery_query_op(
-      query=query,
-      project_id=project_id,
-      dataset_id=dataset_id,
-      table_id='',
-      output_gcs_path=validation_file_path,
-      dataset_location=dataset_location)
-
-  # Create the testing split
-  query = generate_sampling_query(
-      source_table_name=source_table_name, num_lots=10, lots=[9])
-
-  testing_file_path = '{}/{}'.format(gcs_root, TESTING_FILE_PATH)
-
-  create_testing_split = bigquery_query_op(
-      query=query,
-      project_id=project_id,
-      dataset_id=dataset_id,
-      table_id='',
-      output_gcs_path=testing_file_path,
-      dataset_location=dataset_location)
+      dataset_location=dataset_location,
+      training_lots=','.join(str(lot) for lot in TRAINING_LOTS),
+      validation_lots=','.join(str(lot) for lot in VALIDATION_LOTS),
+      testing_lots=','.join(str(lot) for lot in TESTING_LOTS),
+      lot_column='lot')
 
   # Tune hyperparameters
-  tune_args = [
-      '--training_dataset_path',
-      create_training_split.outputs['output_gcs_path'],
-      '--validation_dataset_path',
-      create_validation_split.outputs['output_gcs_path'], '--hptune', 'True'
-  ]
-
-  job_dir = '{}/{}/{}'.format(gcs_root, 'jobdir/hypertune',
-                              kfp.dsl.RUN_ID_PLACEHOLDER)
-
-  hypertune = mlengine_train_op(
-      project_id=project_id,
-      region=region,
-      master_image_uri=TRAINER_IMAGE,
-      job_dir=job_dir,
-      args=tune_args,
-      training_input=hypertune_settings)
-
-  # Retrieve the best trial
-  get_best_trial = retrieve_best_run_op(project_id, hypertune.outputs['job_id'])
-
-  # Train the model on a combined training and validation datasets
+  hypertune_job_dir = '{}/{}/{}'.format(gcs_root, 'jobdir/hypertune',
+                                        kfp.dsl.RUN_ID_PLACEHOLDER)
+
+  if TUNING_MODE == 'sweep':
+    tune_args = [
+        'sweep', '--training_dataset_path',
+        create_splits.outputs['training_gcs_path'],
+        '--validation_dataset_path',
+        create_splits.outputs['validation_gcs_path'], '--search_spec',
+        hypertune_settings
+    ]
+
+    hypertune = mlengine_train_op(
+        project_id=project_id,
+        region=region,
+        master_image_uri=TRAINER_IMAGE,
+        job_dir=hypertune_job_dir,
+        args=tune_args)
+
+    # Retrieve the best trial from the sweep results
+    get_best_trial = retrieve_best_run_op(
+        project_id, hypertune.outputs['job_id'],
+        results_path='{}/sweep_results.json'.format(hypertune_job_dir))
+  else:
+    tune_args = [
+        '--training_dataset_path',
+        create_splits.outputs['training_gcs_path'],
+        '--validation_dataset_path',
+        create_splits.outputs['validation_gcs_path'], '--hptune', 'True',
+        '--save_trial', 'True'
+    ]
+
+    hypertune = mlengine_train_op(
+        project_id=project_id,
+        region=region,
+        master_image_uri=TRAINER_IMAGE,
+        job_dir=hypertune_job_dir,
+        args=tune_args,
+        training_input=hypertune_settings)
+
+    # Retrieve the best trial
+    get_best_trial = retrieve_best_run_op(project_id,
+                                          hypertune.outputs['job_id'])
+
+  # Train the model on a combined training and validation datasets, starting
+  # from the model of the best trial
   job_dir = '{}/{}/{}'.format(gcs_root, 'jobdir', kfp.dsl.RUN_ID_PLACEHOLDER)
 
   train_args = [
       '--training_dataset_path',
-      create_training_split.outputs['output_gcs_path'],
+      create_splits.outputs['training_gcs_path'],
       '--validation_dataset_path',
-      create_validation_split.outputs['output_gcs_path'], '--alpha',
+      create_splits.outputs['validation_gcs_path'], '--alpha',
       get_best_trial.outputs['alpha'], '--max_iter',
-      get_best_trial.outputs['max_iter'], '--hptune', 'False'
+      get_best_trial.outputs['max_iter'], '--hptune', 'False',
+      '--warm_start_dir', '{}/{}'.format(hypertune_job_dir,
+                                         get_best_trial.outputs['trial_id'])
   ]
 
   train_model = mlengine_train_op(
@@ -199,7 +210,7 @@ def covertype_train(project_id: GCPProjectID,
 
   # Evaluate the model on the testing split
   eval_model = evaluate_model_op(
-      dataset_path=str(create_testing_split.outputs['output_gcs_path']),
+      dataset_path=str(create_splits.outputs['testing_gcs_path']),
       model_path=str(train_model.outputs['job_dir']),
       metric_name=evaluation_metric_name)
 
@@ -0,0 +1,93 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the export of the splits against a local SQLite database."""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import helper_components
+
+# A query in the form of generate_sampling_query(..., lot_column='lot')
+SAMPLING_QUERY = """
+       SELECT *,
+           MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(cover))), 10) AS lot
+       FROM
+           `covertype_dataset.covertype` AS cover
+       WHERE
+       MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(cover))), 10) IN ({})
+       """
+
+
+class ExportSplitsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.db_path = os.path.join(self.temp_dir, 'covertype.db')
+    rows = np.arange(5000)
+    self.df = pd.DataFrame({
+        'Elevation': 1800 + rows % 2000,
+        'Slope': rows % 66,
+        'Soil_Type': ['C{}'.format(2702 + row % 40) for row in rows],
+        'Cover_Type': rows % 7 + 1,
+    })
+    with sqlite3.connect(self.db_path) as connection:
+      self.df.to_sql('covertype_dataset.covertype', connection, index=False)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def export(self, lots, output_dir, **split_lots):
+    paths = helper_components.export_splits(
+        SAMPLING_QUERY.format(', '.join(str(lot) for lot in lots)),
+        os.path.join(self.temp_dir, output_dir),
+        sqlite_db_path=self.db_path, page_size=1000, **split_lots)
+    return [pd.read_csv(path) for path in paths]
+
+  def test_every_row_is_assigned_a_lot(self):
+    training, validation, testing = self.export(
+        range(10), 'all', training_lots=','.join(map(str, range(8))))
+    self.assertEqual(len(training) + len(validation) + len(testing),
+                     len(self.df))
+    columns = list(self.df.columns)
+    pd.testing.assert_frame_equal(
+        pd.concat([training, validation, testing]).sort_values(
+            columns).reset_index(drop=True),
+        self.df.sort_values(columns).reset_index(drop=True))
+    for split in (training, validation, testing):
+      self.assertGreater(len(split), 0)
+
+  def test_single_query_matches_one_query_per_split(self):
+    splits = self.export([1, 2, 3, 4, 8, 9], 'single')
+    self.assertEqual(list(splits[0].columns), list(self.df.columns))
+    for split, lots in zip(splits, ([1, 2, 3, 4], [8], [9])):
+      lots = ','.join(map(str, lots))
+      separate = self.export([lots], 'separate', training_lots=lots,
+                             validation_lots=lots, testing_lots=lots)[0]
+      pd.testing.assert_frame_equal(split, separate)
+
+  def test_lots_are_deterministic(self):
+    first = self.export([1, 2, 3, 4, 8, 9], 'first')
+    second = self.export([1, 2, 3, 4, 8, 9], 'second')
+    for first_split, second_split in zip(first, second):
+      pd.testing.assert_frame_equal(first_split, second_split)
+
+
+if __name__ == '__main__':
+  unittest.main()
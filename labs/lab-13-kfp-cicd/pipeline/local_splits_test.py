@@ -0,0 +1,59 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the local covertype data splits."""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import local_splits
+
+
+class AssignLotsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.df = pd.DataFrame({
+        'Elevation': np.arange(1000, 2000, dtype=np.int64),
+        'Slope': np.arange(1000, dtype=np.int32) % 66,
+        'Soil_Type': ['C{}'.format(2702 + code % 40) for code in range(1000)],
+        'Cover_Type': np.arange(1000) % 7 + 1,
+    })
+
+  def test_lots_do_not_depend_on_dtypes(self):
+    lots = local_splits.assign_lots(self.df)
+    widened = self.df.astype({'Elevation': np.float64, 'Slope': np.float32,
+                              'Cover_Type': np.uint8})
+    np.testing.assert_array_equal(local_splits.assign_lots(widened), lots)
+
+  def test_missing_value_does_not_move_other_rows(self):
+    lots = local_splits.assign_lots(self.df)
+    with_missing = self.df.astype({'Slope': np.float64})
+    with_missing.loc[0, 'Slope'] = np.nan
+    np.testing.assert_array_equal(
+        local_splits.assign_lots(with_missing)[1:], lots[1:])
+
+  def test_fractional_values_keep_their_lots(self):
+    df = pd.DataFrame({'x': np.arange(1000) + 0.5})
+    np.testing.assert_array_equal(
+        local_splits.assign_lots(df.astype(np.float32)),
+        local_splits.assign_lots(df))
+
+  def test_lots_cover_all_values(self):
+    lots = local_splits.assign_lots(self.df)
+    self.assertEqual(sorted(set(lots)), list(range(local_splits.NUM_LOTS)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,378 @@
+# Copyright 2019 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local benchmarks for the covertype trainer."""
+
+import os
+import pickle
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import fire
+import joblib
+import numpy as np
+import pandas as pd
+import psutil
+import scipy.sparse
+
+from sklearn.compose import ColumnTransformer
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler, OneHotEncoder
+
+import train
+
+COVERTYPE_NUM_ROWS = 581012
+
+NUMERIC_FEATURE_RANGES = [
+    ('Elevation', 1859, 3858),
+    ('Aspect', 0, 360),
+    ('Slope', 0, 66),
+    ('Horizontal_Distance_To_Hydrology', 0, 1397),
+    ('Vertical_Distance_To_Hydrology', -173, 601),
+    ('Horizontal_Distance_To_Roadways', 0, 7117),
+    ('Hillshade_9am', 0, 254),
+    ('Hillshade_Noon', 0, 254),
+    ('Hillshade_3pm', 0, 254),
+    ('Horizontal_Distance_To_Fire_Points', 0, 7173),
+]
+WILDERNESS_AREAS = ['Rawah', 'Neota', 'Commanche', 'Cache']
+SOIL_TYPES = ['C{}'.format(code) for code in range(2702, 2742)]
+
+
+def synthetic_covertype(num_rows=COVERTYPE_NUM_ROWS, seed=0):
+  """Generates a synthetic DataFrame with the covertype schema."""
+
+  rng = np.random.RandomState(seed)
+  df = pd.DataFrame({
+      name: rng.randint(low, high + 1, size=num_rows)
+      for name, low, high in NUMERIC_FEATURE_RANGES
+  })
+  df['Wilderness_Area'] = rng.choice(WILDERNESS_AREAS, size=num_rows)
+  df['Soil_Type'] = rng.choice(SOIL_TYPES, size=num_rows)
+
+  # Make the label depend on the features so that accuracies are meaningful.
+  elevation_bins = np.digitize(df['Elevation'], np.linspace(1859, 3858, 8)[1:-1])
+  noise = rng.randint(0, 7, size=num_rows)
+  df[train.LABEL_COLUMN] = np.where(rng.rand(num_rows) < 0.7,
+                                    elevation_bins, noise) + 1
+
+  return df
+
+
+def generate_covertype(path, num_rows=COVERTYPE_NUM_ROWS, seed=0):
+  """Writes a synthetic CSV file with the covertype schema."""
+
+  synthetic_covertype(num_rows, seed).to_csv(path, index=False)
+  return path
+
+
+def _write_splits(df, workdir, fractions=(0.6, 0.8)):
+  """Writes shuffled training, validation and testing splits of a DataFrame."""
+
+  splits = np.split(df.sample(frac=1, random_state=0),
+                    [int(len(df) * fraction) for fraction in fractions])
+  paths = []
+  for name, split in zip(('training', 'validation', 'testing'), splits):
+    paths.append(os.path.join(workdir, '{}.csv'.format(name)))
+    split.to_csv(paths[-1], index=False)
+  return paths
+
+
+def _timeit(func, repeats):
+  """Returns the best wall time of repeated calls to func."""
+
+  timings = []
+  for _ in range(repeats):
+    start = time.time()
+    func()
+    timings.append(time.time() - start)
+  return min(timings)
+
+
+def dataset_cache(num_rows=COVERTYPE_NUM_ROWS, repeats=3):
+  """Compares cold CSV loading with warm dataset cache loading."""
+
+  with tempfile.TemporaryDirectory() as workdir:
+    csv_path = generate_covertype(os.path.join(workdir, 'data.csv'), num_rows)
+    cache_dir = os.path.join(workdir, 'cache')
+
+    csv_time = _timeit(lambda: train.load_dataset(csv_path), repeats)
+    start = time.time()
+    train.load_dataset(csv_path, cache_dir)
+    conversion_time = time.time() - start
+    cached_time = _timeit(lambda: train.load_dataset(csv_path, cache_dir),
+                          repeats)
+
+  print('Rows: {}'.format(num_rows))
+  print('CSV load: {:.3f}s'.format(csv_time))
+  print('First cached load (includes conversion): {:.3f}s'.format(
+      conversion_time))
+  print('Warm cached load: {:.3f}s'.format(cached_time))
+  print('Speedup: {:.1f}x'.format(csv_time / cached_time))
+
+
+def _matrix_nbytes(matrix):
+  """Returns the memory used by a dense or a sparse matrix."""
+
+  if scipy.sparse.issparse(matrix):
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+  return matrix.nbytes
+
+
+def _format_seconds(seconds):
+  """Formats an optional duration for the benchmark tables."""
+
+  return '-' if seconds is None else '{:.2f}s'.format(seconds)
+
+
+def _format_megabytes(num_bytes):
+  """Formats an optional memory size for the benchmark tables."""
+
+  return '-' if num_bytes is None else '{:.1f}MB'.format(num_bytes / 2**20)
+
+
+def _peak_rss_increase(func):
+  """Calls func and returns its result and the peak increase of the RSS.
+
+  The RSS of the process is sampled every millisecond while func runs.
+  """
+
+  process = psutil.Process()
+  start_rss = process.memory_info().rss
+  peak_rss = [start_rss]
+  done = threading.Event()
+
+  def sample():
+    while not done.wait(0.001):
+      peak_rss[0] = max(peak_rss[0], process.memory_info().rss)
+
+  sampler = threading.Thread(target=sample)
+  sampler.start()
+  try:
+    result = func()
+  finally:
+    done.set()
+    sampler.join()
+  return result, max(peak_rss[0], process.memory_info().rss) - start_rss
+
+
+def _hist_gradient_boosting():
+  """Returns a histogram gradient boosting classifier."""
+
+  try:
+    from sklearn.experimental import enable_hist_gradient_boosting  # pylint: disable=unused-import
+  except ImportError:
+    pass
+  from sklearn.ensemble import HistGradientBoostingClassifier
+  return HistGradientBoostingClassifier(max_iter=20)
+
+
+def feature_layouts(num_rows=(500000, 5000000), max_iter=5,
+                    dtypes=('float64', 'float32')):
+  """Compares memory and fit time of the feature matrix layouts.
+
+  The baseline is the original preprocessor that leaves the output format to
+  the ColumnTransformer heuristics. Every layout, the baseline included, is
+  converted with to_compact_matrix to each of the dtypes. Linear model fit
+  times are measured with SGDClassifier and the codes layout is compared with
+  the dense layout using a gradient boosted trees classifier. The peak RSS
+  increase of each fit includes the copies the estimators make of matrices
+  that are not float64.
+  """
+
+  if isinstance(num_rows, int):
+    num_rows = [num_rows]
+  if isinstance(dtypes, str):
+    dtypes = dtypes.split(',')
+
+  baseline = ColumnTransformer(
+    transformers=[
+        ('num', StandardScaler(), train.NUMERIC_FEATURE_INDEXES),
+        ('cat', OneHotEncoder(), train.CATEGORICAL_FEATURE_INDEXES)
+    ])
+  layouts = [('baseline', baseline)] + [
+      (layout, train.build_preprocessor(layout))
+      for layout in train.FEATURE_LAYOUTS
+  ]
+
+  print('{:>9} {:>9} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+      'rows', 'layout', 'dtype', 'MB', 'sgd fit', 'sgd peak', 'trees fit',
+      'trees peak'))
+  for rows in num_rows:
+    df = synthetic_covertype(rows)
+    X = df.drop(train.LABEL_COLUMN, axis=1)
+    y = df[train.LABEL_COLUMN].values
+    del df
+
+    for name, preprocessor in layouts:
+      transformed = preprocessor.fit_transform(X)
+      for dtype in dtypes:
+        matrix = train.to_compact_matrix(transformed, np.dtype(dtype))
+
+        sgd_time, sgd_peak = None, None
+        if name != 'codes':
+          start = time.time()
+          _, sgd_peak = _peak_rss_increase(lambda: SGDClassifier(
+              loss='log', max_iter=max_iter, tol=None).fit(matrix, y))
+          sgd_time = time.time() - start
+
+        trees_time, trees_peak = None, None
+        if name in ('dense', 'codes'):
+          start = time.time()
+          _, trees_peak = _peak_rss_increase(
+              lambda: _hist_gradient_boosting().fit(matrix, y))
+          trees_time = time.time() - start
+
+        print('{:>9} {:>9} {:>7} {:>10.1f} {:>10} {:>10} {:>10} {:>10}'.format(
+            rows, name, str(matrix.dtype), _matrix_nbytes(matrix) / 2**20,
+            _format_seconds(sgd_time), _format_megabytes(sgd_peak),
+            _format_seconds(trees_time), _format_megabytes(trees_peak)))
+        del matrix
+      del transformed
+
+
+def _load_pickle(path):
+  """Loads a pickled model file."""
+
+  with open(path, 'rb') as model_file:
+    return pickle.load(model_file)
+
+
+def model_formats(num_rows=100000, vocabulary_size=None, repeats=5):
+  """Compares the size and the load latency of the model export formats.
+
+  The covertype model is only a few kilobytes. Set vocabulary_size to draw
+  the soil types from a larger vocabulary, which grows the one-hot encoded
+  coefficient matrix of the model.
+  """
+
+  df = synthetic_covertype(num_rows)
+  if vocabulary_size:
+    codes = np.random.RandomState(0).randint(vocabulary_size, size=num_rows)
+    df['Soil_Type'] = pd.Series(codes).map('S{}'.format)
+  pipeline = Pipeline([
+    ('preprocessor', train.build_preprocessor()),
+    ('classifier', SGDClassifier(loss='log', max_iter=5, tol=None))
+  ])
+  pipeline.fit(df.drop(train.LABEL_COLUMN, axis=1), df[train.LABEL_COLUMN])
+
+  loaders = [
+      ('pickle', 'pickle', _load_pickle),
+      ('joblib', 'joblib', joblib.load),
+      ('joblib mmap', 'joblib',
+       lambda path: joblib.load(path, mmap_mode='r')),
+  ]
+
+  print('{:>12} {:>10} {:>10} {:>10}'.format('format', 'KB', 'save', 'load'))
+  with tempfile.TemporaryDirectory() as workdir:
+    for name, model_format, load in loaders:
+      save_time = _timeit(
+          lambda: train.save_model(pipeline, workdir, model_format), repeats)
+      model_path = os.path.join(workdir, train.MODEL_FILENAMES[model_format])
+      load_time = _timeit(lambda: load(model_path), repeats)
+      print('{:>12} {:>10.1f} {:>9.2f}ms {:>9.2f}ms'.format(
+          name, os.path.getsize(model_path) / 2**10, save_time * 1000,
+          load_time * 1000))
+
+
+def warm_start(num_rows=500000, alpha=0.0001, max_iter=500,
+               warm_start_epochs=(1, 2, 3)):
+  """Compares the final training from scratch with warm starts from a trial.
+
+  A trial model is trained on the training split and saved the way the
+  tuning trials save it. The final model is then trained on the training
+  and validation splits from scratch and warm-started from the trial, and
+  the training times and the accuracies on the testing split are compared.
+  """
+
+  with tempfile.TemporaryDirectory() as workdir:
+    training_path, validation_path, testing_path = _write_splits(
+        synthetic_covertype(num_rows), workdir)
+    cache_dir = os.path.join(workdir, 'cache')
+    df_test = pd.read_csv(testing_path)
+    X_test = df_test.drop(train.LABEL_COLUMN, axis=1)
+    y_test = df_test[train.LABEL_COLUMN]
+
+    def run(job_dir, **kwargs):
+      start = time.time()
+      train.train_evaluate(job_dir, training_path, validation_path, alpha,
+                           max_iter, cache_dir=cache_dir, **kwargs)
+      return time.time() - start
+
+    trial_dir = os.path.join(workdir, 'trial')
+    os.environ['CLOUD_ML_TRIAL_ID'] = '1'
+    try:
+      trial_time = run(trial_dir, hptune=True, save_trial=True)
+    finally:
+      del os.environ['CLOUD_ML_TRIAL_ID']
+
+    final_dir = os.path.join(workdir, 'final')
+    runs = [('scratch', {})] + [
+        ('warm {} epochs'.format(epochs),
+         {'warm_start_dir': os.path.join(trial_dir, '1'),
+          'warm_start_epochs': epochs}) for epochs in warm_start_epochs]
+    results = []
+    for name, kwargs in runs:
+      elapsed = run(final_dir, hptune=False, **kwargs)
+      accuracy = train.load_model(final_dir).score(X_test, y_test)
+      results.append((name, elapsed, accuracy))
+
+    print('Trial training: {:.2f}s'.format(trial_time))
+    print('{:>16} {:>10} {:>10}'.format('final model', 'time', 'accuracy'))
+    for name, elapsed, accuracy in results:
+      print('{:>16} {:>9.2f}s {:>10.4f}'.format(name, elapsed, accuracy))
+
+
+def streaming(num_rows=(250000, 1000000), chunk_size=50000, epochs=5,
+              alpha=0.0001, max_iter=500):
+  """Compares the streaming and the in-memory training of the final model.
+
+  Reports the training time, the peak memory allocated during training and
+  the accuracy on the testing split for each dataset size. The streaming
+  peak should not grow with the number of rows.
+  """
+
+  if isinstance(num_rows, int):
+    num_rows = [num_rows]
+  print('{:>10} {:>10} {:>10} {:>12} {:>10}'.format(
+      'rows', 'mode', 'time', 'peak MB', 'accuracy'))
+  for rows in num_rows:
+    with tempfile.TemporaryDirectory() as workdir:
+      training_path, validation_path, testing_path = _write_splits(
+          synthetic_covertype(rows), workdir)
+      df_test = pd.read_csv(testing_path)
+      for mode, streaming_mode in (('in-memory', False), ('streaming', True)):
+        job_dir = os.path.join(workdir, mode)
+        tracemalloc.start()
+        start = time.time()
+        try:
+          train.train_evaluate(job_dir, training_path, validation_path, alpha,
+                               max_iter, hptune=False, cache_dir=None,
+                               streaming=streaming_mode, chunk_size=chunk_size,
+                               epochs=epochs)
+          elapsed = time.time() - start
+          peak = tracemalloc.get_traced_memory()[1]
+        finally:
+          tracemalloc.stop()
+        accuracy = train.load_model(job_dir).score(
+            df_test.drop(train.LABEL_COLUMN, axis=1),
+            df_test[train.LABEL_COLUMN])
+        print('{:>10} {:>10} {:>9.2f}s {:>12.1f} {:>10.4f}'.format(
+            rows, mode, elapsed, peak / 2**20, accuracy))
+
+
+if __name__ == '__main__':
+  fire.Fire()
@@ -0,0 +1,325 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Validates and benchmarks the local CLV feature engineering.
+
+The reference results are computed by running the BigQuery query templates
+in SQLite, with a few dialect shims applied to the rendered queries.
+"""
+
+import datetime
+import multiprocessing
+import os
+import re
+import resource
+import sqlite3
+import tempfile
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+
+import clv_features
+import query_templates
+
+TEST_TRANSACTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '../../datasets/clv/test_transactions.csv')
+QUERY_TEMPLATE = 'query_template.sql.jinja'
+WINDOWED_QUERY_TEMPLATE = 'query_template_windowed.sql.jinja'
+QUERY_PARAMS = dict(threshold_date='2011-08-08', predict_end='2011-12-12',
+                    max_monetary=15000)
+TABLE_NAME = 'transactions'
+
+
+def _date_diff(end, start, part):
+  """DATE_DIFF(end, start, DAY) for ISO date strings."""
+
+  if end is None or start is None:
+    return None
+  return (datetime.datetime.strptime(end, '%Y-%m-%d') -
+          datetime.datetime.strptime(start, '%Y-%m-%d')).days
+
+
+def _round(value, digits):
+  """ROUND with the BigQuery half away from zero semantics."""
+
+  return None if value is None else float(
+      clv_features.bigquery_round(value, digits))
+
+
+def to_sqlite(query):
+  """Adapts a rendered BigQuery query to SQLite."""
+
+  query = re.sub(r',\s*DAY\)', ", 'DAY')", query.replace("DATE '", "'"))
+  return query.replace('recency/cnt_orders', 'recency * 1.0 / cnt_orders')
+
+
+def _sqlite_query(template_path, **params):
+  """Renders a CLV query template for SQLite.
+
+  The customer_id column the templates leave commented out is selected too,
+  so the results can be compared by customer.
+  """
+
+  query = query_templates.render_file(
+      template_path, data_source_id=TABLE_NAME, **params)
+  return to_sqlite(query).replace('--  tf.customer_id,', 'tf.customer_id,')
+
+
+def count_table_scans(template_path=QUERY_TEMPLATE, **params):
+  """Counts the query plan steps that read the source table in SQLite.
+
+  A correlated subquery over the source table counts as one step, although
+  it runs once for every row of the outer query.
+  """
+
+  query = _sqlite_query(template_path, **params)
+  names = {TABLE_NAME} | {
+      alias for alias in re.findall(
+          r'\b{}\b`?\s+(?:AS\s+)?(\w+)'.format(TABLE_NAME), query)
+      if alias.upper() not in ('WHERE', 'GROUP', 'ON', 'JOIN')}
+
+  connection = sqlite3.connect(':memory:')
+  connection.create_function('DATE_DIFF', 3, _date_diff)
+  try:
+    connection.execute('CREATE TABLE {} (customer_id, order_date, quantity, '
+                       'unit_price)'.format(TABLE_NAME))
+    plan = connection.execute('EXPLAIN QUERY PLAN ' + query)
+    return sum(detail.split(' ')[0] in ('SCAN', 'SEARCH') and
+               detail.split(' ')[1] in names for *_, detail in plan)
+  finally:
+    connection.close()
+
+
+def run_in_sqlite(transactions, template_path=QUERY_TEMPLATE, **params):
+  """Runs a CLV query template against the transactions in SQLite."""
+
+  query = _sqlite_query(template_path, **params)
+  connection = sqlite3.connect(':memory:')
+  connection.create_function('DATE_DIFF', 3, _date_diff)
+  connection.create_function('ROUND', 2, _round)
+  try:
+    transactions.to_sql(TABLE_NAME, connection, index=False)
+    # Turns the correlated latest_order subquery into an index lookup
+    connection.execute('CREATE INDEX customer_dates ON {} '
+                       '(customer_id, order_date)'.format(TABLE_NAME))
+    df = pd.read_sql(query, connection)
+  finally:
+    connection.close()
+  return df.set_index('customer_id').sort_index()
+
+
+def synthetic_transactions(num_transactions, num_customers=None, seed=0):
+  """Generates synthetic sales transactions over one year."""
+
+  rng = np.random.RandomState(seed)
+  num_customers = num_customers or max(num_transactions // 5, 1)
+  start = np.datetime64('2010-12-01')
+  quantity = rng.geometric(0.3, size=num_transactions)
+  quantity[rng.rand(num_transactions) < 0.05] *= -1
+  return pd.DataFrame({
+      'customer_id': pd.Series(
+          rng.randint(num_customers, size=num_transactions)).map(str),
+      'order_date': (start + rng.randint(
+          374, size=num_transactions).astype('timedelta64[D]')).astype(str),
+      'quantity': quantity,
+      'unit_price': rng.choice([0.5, 0.85, 1.25, 2.1, 3.75, 4.95, 12.75],
+                               size=num_transactions),
+  })
+
+
+def assert_same_features(expected, actual):
+  """Checks that two feature DataFrames have the same customers and values."""
+
+  expected = expected[clv_features.FEATURE_COLUMNS]
+  actual = actual[clv_features.FEATURE_COLUMNS]
+  if not expected.index.equals(actual.index):
+    raise AssertionError('The customers differ: {} vs {}'.format(
+        len(expected), len(actual)))
+  np.testing.assert_allclose(actual.values.astype(np.float64),
+                             expected.values.astype(np.float64),
+                             rtol=1e-12, atol=1e-9)
+
+
+def validate(path=TEST_TRANSACTIONS, num_transactions=200000):
+  """Compares the vectorized features with the query template in SQLite."""
+
+  datasets = [
+      ('test_transactions', clv_features.read_transactions(path)),
+      ('synthetic', synthetic_transactions(num_transactions)),
+  ]
+  for name, transactions in datasets:
+    expected = run_in_sqlite(transactions, **QUERY_PARAMS)
+    actual = clv_features.compute_features(transactions, **QUERY_PARAMS)
+    assert_same_features(expected, actual)
+    print('{}: {} customers match'.format(name, len(actual)))
+
+
+def compare_templates(path=TEST_TRANSACTIONS, num_transactions=200000):
+  """Compares the windowed query template with the original template."""
+
+  datasets = [
+      ('test_transactions', clv_features.read_transactions(path)),
+      ('synthetic', synthetic_transactions(num_transactions)),
+  ]
+  templates = [QUERY_TEMPLATE, WINDOWED_QUERY_TEMPLATE]
+  for template_path in templates:
+    print('{}: {} source table accesses'.format(
+        template_path, count_table_scans(template_path, **QUERY_PARAMS)))
+
+  for name, transactions in datasets:
+    results = []
+    for template_path in templates:
+      start = time.time()
+      results.append(run_in_sqlite(transactions, template_path,
+                                   **QUERY_PARAMS))
+      print('{} {}: {:.2f}s'.format(name, template_path, time.time() - start))
+    pd.testing.assert_frame_equal(results[0], results[1])
+    print('{}: {} customers match'.format(name, len(results[0])))
+
+
+def incremental(path=TEST_TRANSACTIONS, num_batches=10, window_days=120,
+                num_transactions=1000000):
+  """Compares incremental features with full recomputes on time ordered batches.
+
+  After each batch, the features are computed with predict_end at the last
+  order date seen and threshold_date window_days earlier, both incrementally
+  and from all the transactions seen so far.
+  """
+
+  datasets = [
+      ('test_transactions', clv_features.read_transactions(path)),
+      ('synthetic', synthetic_transactions(num_transactions)),
+  ]
+  for name, transactions in datasets:
+    transactions = transactions.sort_values('order_date', kind='mergesort')
+    state = clv_features.IncrementalFeatures()
+    incremental_time = recompute_time = 0
+    for batch in np.array_split(np.arange(len(transactions)), num_batches):
+      predict_end = np.datetime64(transactions['order_date'].iloc[batch[-1]])
+      threshold_date = predict_end - np.timedelta64(window_days, 'D')
+      params = dict(threshold_date=threshold_date, predict_end=predict_end,
+                    max_monetary=QUERY_PARAMS['max_monetary'])
+
+      start = time.time()
+      state.update(transactions.iloc[batch])
+      actual = state.compute_features(**params)
+      incremental_time += time.time() - start
+      start = time.time()
+      expected = clv_features.compute_features(
+          transactions.iloc[:batch[-1] + 1], **params)
+      recompute_time += time.time() - start
+      assert_same_features(expected, actual)
+
+    print('{}: {} batches match, incremental {:.2f}s, recompute {:.2f}s'.format(
+        name, num_batches, incremental_time, recompute_time))
+
+
+def _measured(function, *args):
+  """Calls a function in a forked child process.
+
+  Returns the result, the duration and the peak RSS increase of the call. The
+  peak RSS of a forked child starts at the RSS of the parent, so ru_maxrss
+  measures every allocation of the call, including the Arrow and NumPy
+  buffers that tracemalloc does not see. The result must be picklable.
+  """
+
+  context = multiprocessing.get_context('fork')
+  receiver, sender = context.Pipe(duplex=False)
+
+  def run():
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sender.send((result, elapsed, (peak_rss - start_rss) * 1024))
+
+  process = context.Process(target=run)
+  process.start()
+  try:
+    return receiver.recv()
+  except EOFError:
+    raise RuntimeError('The measured call failed with exit code {}'.format(
+        process.exitcode))
+  finally:
+    process.join()
+
+
+def streaming(num_transactions=5000000, chunk_size=1000000):
+  """Compares the streaming typed ingest with reading the whole CSV file.
+
+  Reports the time and the peak RSS increase while reading a synthetic
+  transactions file as a DataFrame and as typed record batches, each in its
+  own process, and checks that the features computed from the batches with
+  IncrementalFeatures match the features of the DataFrame.
+  """
+
+  def read_dataframe(path):
+    transactions = clv_features.read_transactions(path)
+    return transactions.memory_usage(deep=True).sum()
+
+  def read_batches(path):
+    batch_bytes = 0
+    for batch in clv_features.read_transaction_batches(path, chunk_size):
+      batch_bytes = max(batch_bytes, batch.nbytes)
+    return batch_bytes
+
+  with tempfile.NamedTemporaryFile(suffix='.csv') as csv_file:
+    synthetic_transactions(num_transactions).to_csv(csv_file.name,
+                                                    index=False)
+    dataframe_bytes, elapsed, peak = _measured(read_dataframe, csv_file.name)
+    print('DataFrame: {:.2f}s, {:.1f}MB, peak RSS +{:.1f}MB'.format(
+        elapsed, dataframe_bytes / 2**20, peak / 2**20))
+    batch_bytes, elapsed, peak = _measured(read_batches, csv_file.name)
+    print('Record batches: {:.2f}s, {:.1f}MB per batch, '
+          'peak RSS +{:.1f}MB'.format(elapsed, batch_bytes / 2**20,
+                                      peak / 2**20))
+
+    transactions = clv_features.read_transactions(csv_file.name)
+    expected = clv_features.compute_features(transactions, **QUERY_PARAMS)
+    state = clv_features.IncrementalFeatures()
+    for batch in clv_features.read_transaction_batches(csv_file.name,
+                                                       chunk_size):
+      state.update(batch)
+    actual = state.compute_features(materialize=False, **QUERY_PARAMS)
+  assert_same_features(expected, actual)
+  print('{} transactions: {} customers match'.format(num_transactions,
+                                                    len(actual)))
+
+
+def benchmark(num_transactions=10000000, sqlite_transactions=200000):
+  """Times the vectorized features and the query template in SQLite."""
+
+  transactions = synthetic_transactions(num_transactions)
+  start = time.time()
+  features = clv_features.compute_features(transactions, **QUERY_PARAMS)
+  elapsed = time.time() - start
+  print('Vectorized: {} transactions, {} customers in {:.2f}s'.format(
+      num_transactions, len(features), elapsed))
+
+  transactions = transactions[:sqlite_transactions]
+  start = time.time()
+  run_in_sqlite(transactions, **QUERY_PARAMS)
+  sqlite_elapsed = time.time() - start
+  start = time.time()
+  clv_features.compute_features(transactions, **QUERY_PARAMS)
+  elapsed = time.time() - start
+  print('{} transactions: SQLite {:.2f}s, vectorized {:.3f}s'.format(
+      sqlite_transactions, sqlite_elapsed, elapsed))
+
+
+if __name__ == '__main__':
+  fire.Fire()
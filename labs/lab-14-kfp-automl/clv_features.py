@@ -0,0 +1,436 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Vectorized CLV feature engineering equivalent to query_template.sql.jinja.
+
+The transactions are sorted once by customer and order date. Daily order
+summaries are aggregated from the contiguous runs of the sorted rows and the
+customer features are aggregated from the daily summaries with bincount, so
+no Python level grouping is involved.
+
+The per customer aggregates are sums, minimums and maximums, so later days
+can be folded into the aggregates of earlier days. IncrementalFeatures uses
+this to fold new transactions into the aggregates of the days before the last
+threshold.
+"""
+
+import numpy as np
+import pandas as pd
+
+FEATURE_COLUMNS = [
+    'monetary', 'frequency', 'recency', 'T', 'time_between',
+    'avg_basket_value', 'avg_basket_size', 'cnt_returns', 'target_monetary'
+]
+# The transactions table schema, customer_id:STRING,order_date:DATE,
+# quantity:INTEGER,unit_price:FLOAT in BigQuery
+TRANSACTION_COLUMNS = ['customer_id', 'order_date', 'quantity', 'unit_price']
+_CSV_DTYPES = {'customer_id': str, 'order_date': str, 'quantity': np.int64,
+               'unit_price': np.float64}
+# Customers must have bought within this many days before predict_end
+MAX_DAYS_SINCE_LATEST_ORDER = 90
+# The per customer aggregates and how they are combined
+AGGREGATES = {
+    'positive_orders': 'sum',
+    'latest_order': 'max',
+    'monetary': 'sum',
+    'frequency': 'sum',
+    'first_order': 'min',
+    'last_order': 'max',
+    'basket_size': 'sum',
+    'returns': 'sum',
+    'target_monetary': 'sum',
+    'target_orders': 'sum',
+}
+# The aggregates of customers without days, far from any real day
+_NO_DAY = {'min': np.iinfo(np.int64).max // 2,
+           'max': np.iinfo(np.int64).min // 2}
+
+
+def bigquery_round(values, digits=0):
+  """Rounds half away from zero like the BigQuery ROUND function."""
+
+  scale = 10.0 ** digits
+  scaled = np.abs(np.asarray(values, dtype=np.float64)) * scale
+  rounded = np.floor(scaled)
+  rounded += scaled - rounded >= 0.5
+  return np.copysign(rounded, values) / scale
+
+
+def to_days(dates):
+  """Converts dates, or days since the epoch, to int64 days since the epoch."""
+
+  if isinstance(dates, (int, np.integer)):
+    return np.int64(dates)
+  if np.isscalar(dates) or isinstance(dates, str):
+    return np.datetime64(dates, 'D').astype(np.int64)
+  if np.asarray(dates).dtype.kind in 'iu':
+    return np.asarray(dates, dtype=np.int64)
+  return pd.to_datetime(dates, format='%Y-%m-%d').values.astype(
+      'datetime64[D]').astype(np.int64)
+
+
+def read_transactions(path):
+  """Reads a transactions CSV file with the lab's BigQuery schema."""
+
+  return pd.read_csv(path, usecols=TRANSACTION_COLUMNS, dtype=_CSV_DTYPES)
+
+
+def read_transaction_batches(path, chunk_size=1000000):
+  """Reads a transactions CSV file as typed Arrow record batches.
+
+  The file is parsed in chunks of chunk_size rows with the lab's BigQuery
+  schema, so memory use is bounded by the chunk size and the number of
+  customers. The batches have the columns:
+
+    customer_id  A dictionary array with int32 customer codes that are
+                 consistent across the batches. The dictionary of each batch
+                 holds the customer ids seen so far.
+    order_date   The int32 days since the epoch.
+    quantity     An int32 number of articles.
+    unit_price   A float64 price, the same precision as the BigQuery FLOAT.
+
+  Args:
+    path: A CSV file with a header row and the TRANSACTION_COLUMNS.
+    chunk_size: The number of rows per batch.
+
+  Yields:
+    pyarrow.RecordBatch objects.
+  """
+
+  import pyarrow as pa  # pylint: disable=g-import-not-at-top
+
+  customer_ids = pd.Index([], dtype=object)
+  dictionary = pa.array([], type=pa.string())
+  int32 = np.iinfo(np.int32)
+  for chunk in pd.read_csv(path, usecols=TRANSACTION_COLUMNS,
+                           dtype=_CSV_DTYPES, chunksize=chunk_size):
+    codes, new_ids = _encode(customer_ids, chunk['customer_id'].values)
+    if len(new_ids):
+      customer_ids = customer_ids.append(new_ids)
+      dictionary = pa.array(customer_ids.values, type=pa.string())
+
+    quantity = chunk['quantity'].values
+    if len(quantity) and (quantity.min() < int32.min or
+                          quantity.max() > int32.max):
+      raise ValueError('Quantities out of the int32 range in {}'.format(path))
+    yield pa.RecordBatch.from_arrays([
+        pa.DictionaryArray.from_arrays(codes.astype(np.int32), dictionary),
+        pa.array(to_days(chunk['order_date']).astype(np.int32)),
+        pa.array(quantity.astype(np.int32)),
+        pa.array(chunk['unit_price'].values),
+    ], TRANSACTION_COLUMNS)
+
+
+def _encode(customer_ids, values):
+  """Returns the codes of the values in customer_ids and the new ids.
+
+  The new ids get the codes after the existing ones, in the order of their
+  first appearance. Categorical values are encoded by their categories.
+  """
+
+  if isinstance(values, pd.Categorical):
+    codes, new_ids = _encode(customer_ids, np.asarray(values.categories))
+    return np.where(values.codes < 0, -1, codes[values.codes]), new_ids
+
+  codes = customer_ids.get_indexer(values)
+  unknown = codes < 0
+  new_ids = pd.Index(pd.unique(values[unknown]))
+  if len(new_ids):
+    codes[unknown] = len(customer_ids) + new_ids.get_indexer(values[unknown])
+  return codes, new_ids
+
+
+def _group_bounds(codes):
+  """Returns the first and the last index of each run of equal codes."""
+
+  starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+  ends = np.r_[starts[1:], len(codes)] - 1
+  return starts, ends
+
+
+def reduce_daily_summaries(customer_codes, days, values, articles):
+  """Sums daily order summaries, or transactions, by customer and day.
+
+  Returns the customer codes, the days, the unrounded order values and the
+  numbers of articles of the summaries, sorted by customer code and day.
+  """
+
+  if not len(customer_codes):
+    return customer_codes, days, values, articles
+
+  order = np.lexsort((days, customer_codes))
+  customer_codes = customer_codes[order]
+  days = days[order]
+
+  starts = np.flatnonzero(np.r_[True, (customer_codes[1:] != customer_codes[:-1]) |
+                                (days[1:] != days[:-1])])
+  values = np.add.reduceat(values[order], starts)
+  articles = np.add.reduceat(articles[order], starts)
+  return customer_codes[starts], days[starts], values, articles
+
+
+def daily_summaries(customer_codes, days, quantity, unit_price):
+  """Aggregates the transactions into per customer, per day order summaries."""
+
+  return reduce_daily_summaries(customer_codes, days, unit_price * quantity,
+                                quantity)
+
+
+def aggregate_summaries(customer_codes, days, values, articles, num_customers,
+                        threshold_date, initial=None):
+  """Aggregates sorted daily order summaries by customer.
+
+  The days up to threshold_date are aggregated into the features and the
+  later days into the target. If the initial aggregates of earlier days are
+  given, the days are folded into them, adding the values in the same order
+  as aggregating all the days at once would, so the float sums are identical.
+  Returns a dictionary with the AGGREGATES arrays.
+  """
+
+  threshold = to_days(threshold_date)
+  aggregates = {}
+
+  def reduce(name, codes, day_values):
+    """Computes the minimum or the maximum of the sorted days by customer."""
+    result = np.full(num_customers, _NO_DAY[AGGREGATES[name]])
+    if len(codes):
+      starts, ends = _group_bounds(codes)
+      bounds = starts if AGGREGATES[name] == 'min' else ends
+      result[codes[bounds]] = day_values[bounds]
+    return result
+
+  def count(name, codes, weights=None):
+    """Sums the weights by customer, in the order of the days."""
+    if initial is None:
+      return np.bincount(codes, weights=weights, minlength=num_customers)
+    if weights is None:
+      result = initial[name].copy()
+      np.add.at(result, codes, 1)
+    else:
+      # bincount returns integers for empty weights
+      result = initial[name].astype(np.float64)
+      np.add.at(result, codes, weights)
+    return result
+
+  # Customers with more than one positive order before the threshold
+  aggregates['positive_orders'] = count('positive_orders', customer_codes,
+                                        (values > 0) & (days < threshold))
+  aggregates['latest_order'] = reduce('latest_order', customer_codes, days)
+
+  # Only the days with consistent order values and quantities are used
+  order_values = bigquery_round(values, 2)
+  consistent = (((articles > 0) & (order_values > 0)) |
+                ((articles < 0) & (order_values < 0)))
+  before = consistent & (days <= threshold)
+  after = consistent & (days > threshold)
+
+  codes = customer_codes[before]
+  aggregates['monetary'] = count('monetary', codes, order_values[before])
+  aggregates['frequency'] = count('frequency', codes)
+  aggregates['first_order'] = reduce('first_order', codes, days[before])
+  aggregates['last_order'] = reduce('last_order', codes, days[before])
+  aggregates['basket_size'] = count('basket_size', codes, articles[before])
+  aggregates['returns'] = count('returns', codes, order_values[before] < 1)
+  aggregates['target_monetary'] = count('target_monetary',
+                                        customer_codes[after],
+                                        order_values[after])
+  aggregates['target_orders'] = count('target_orders', customer_codes[after])
+
+  if initial is not None:
+    combine = {'min': np.minimum, 'max': np.maximum}
+    for name, method in AGGREGATES.items():
+      if method in combine:
+        aggregates[name] = combine[method](initial[name], aggregates[name])
+  return aggregates
+
+
+def resize_aggregates(aggregates, num_customers):
+  """Extends the aggregates with empty aggregates for new customers."""
+
+  resized = {}
+  for name, method in AGGREGATES.items():
+    values = aggregates[name]
+    resized[name] = np.r_[values, np.full(num_customers - len(values),
+                                          _NO_DAY.get(method, 0),
+                                          dtype=values.dtype)]
+  return resized
+
+
+def select_features(aggregates, threshold_date, predict_end, max_monetary):
+  """Computes the CLV features of the customers selected by the query.
+
+  Returns a dictionary with the customer codes and the FEATURE_COLUMNS arrays.
+  """
+
+  threshold = to_days(threshold_date)
+  predict_end = to_days(predict_end)
+
+  monetary = aggregates['monetary']
+  frequency = aggregates['frequency']
+  customers = np.flatnonzero(
+      (aggregates['positive_orders'] > 1) &
+      (predict_end - aggregates['latest_order'] <=
+       MAX_DAYS_SINCE_LATEST_ORDER) &
+      (frequency > 0) & (aggregates['target_orders'] > 0) &
+      (monetary > 0) & (monetary <= max_monetary))
+
+  frequency = frequency[customers].astype(np.int64)
+  first_order = aggregates['first_order'][customers]
+  recency = aggregates['last_order'][customers] - first_order
+  return {
+      'customer_code': customers,
+      'monetary': bigquery_round(monetary[customers], 2),
+      'frequency': frequency,
+      'recency': recency,
+      'T': threshold - first_order,
+      'time_between': bigquery_round(recency / frequency, 2),
+      'avg_basket_value': bigquery_round(monetary[customers] / frequency, 2),
+      'avg_basket_size': bigquery_round(
+          aggregates['basket_size'][customers] / frequency, 2),
+      'cnt_returns': aggregates['returns'][customers].astype(np.int64),
+      'target_monetary': bigquery_round(
+          aggregates['target_monetary'][customers], 2),
+  }
+
+
+def _features_frame(features, customer_ids):
+  """Converts selected features to a DataFrame sorted by customer_id."""
+
+  index = pd.Index(customer_ids[features.pop('customer_code')],
+                   name='customer_id')
+  return pd.DataFrame(features, index=index,
+                      columns=FEATURE_COLUMNS).sort_index()
+
+
+def compute_features(transactions, threshold_date, predict_end, max_monetary):
+  """Computes the CLV features of query_template.sql.jinja.
+
+  Args:
+    transactions: A DataFrame with the customer_id, order_date, quantity and
+      unit_price columns.
+    threshold_date: The date separating the feature and the target periods.
+    predict_end: The end of the prediction period.
+    max_monetary: The maximum monetary value of the selected customers.
+
+  Returns:
+    A DataFrame with the FEATURE_COLUMNS indexed and sorted by customer_id.
+  """
+
+  customer_codes, customer_ids = pd.factorize(transactions['customer_id'],
+                                              sort=True)
+  summaries = daily_summaries(
+      customer_codes.astype(np.int64),
+      to_days(transactions['order_date']),
+      transactions['quantity'].values,
+      transactions['unit_price'].values.astype(np.float64))
+  aggregates = aggregate_summaries(*summaries,
+                                   num_customers=len(customer_ids),
+                                   threshold_date=threshold_date)
+  features = select_features(aggregates, threshold_date, predict_end,
+                             max_monetary)
+  return _features_frame(features, customer_ids)
+
+
+class IncrementalFeatures(object):
+  """Incrementally maintained CLV features.
+
+  The days before the materialized threshold are kept as per customer
+  aggregates and the later days as daily order summaries. New transactions
+  are reduced into the daily summaries, and materialize() folds the
+  summaries of the days before a new threshold into the aggregates, so the
+  features can be computed without revisiting the older transactions. The
+  transactions have to arrive in time order: transactions before the
+  materialized threshold are rejected.
+  """
+
+  def __init__(self):
+    self.customer_ids = pd.Index([], dtype=object)
+    self.materialized_threshold = None
+    self._aggregates = None
+    self._summaries = (np.zeros(0, dtype=np.int64),
+                       np.zeros(0, dtype=np.int64),
+                       np.zeros(0), np.zeros(0, dtype=np.int64))
+
+  def update(self, transactions):
+    """Folds new transactions into the daily order summaries.
+
+    Args:
+      transactions: A DataFrame with the TRANSACTION_COLUMNS, or a record
+        batch from read_transaction_batches.
+    """
+
+    if not isinstance(transactions, pd.DataFrame):
+      transactions = transactions.to_pandas()
+    days = to_days(transactions['order_date'].values)
+    if (self.materialized_threshold is not None and
+        (days < self.materialized_threshold).any()):
+      raise ValueError('Transactions before the materialized threshold {}'
+                       .format(np.datetime64(self.materialized_threshold, 'D')))
+
+    codes, new_ids = _encode(self.customer_ids,
+                             transactions['customer_id'].values)
+    if len(new_ids):
+      self.customer_ids = self.customer_ids.append(new_ids)
+
+    quantity = transactions['quantity'].values
+    unit_price = transactions['unit_price'].values.astype(np.float64)
+    self._summaries = reduce_daily_summaries(*[
+        np.r_[summary, new] for summary, new in zip(
+            self._summaries,
+            (codes.astype(np.int64), days, unit_price * quantity, quantity))])
+
+  def _closed_aggregates(self):
+    """Returns the aggregates of the materialized days for all customers."""
+
+    if self._aggregates is None:
+      empty = np.zeros(0, dtype=np.int64)
+      return aggregate_summaries(empty, empty, np.zeros(0), empty,
+                                 len(self.customer_ids), 0)
+    return resize_aggregates(self._aggregates, len(self.customer_ids))
+
+  def materialize(self, threshold_date):
+    """Folds the daily order summaries before threshold_date into aggregates."""
+
+    threshold = to_days(threshold_date)
+    if (self.materialized_threshold is not None and
+        threshold < self.materialized_threshold):
+      raise ValueError('The threshold cannot move backwards')
+
+    closed = self._summaries[1] < threshold
+    self._aggregates = aggregate_summaries(
+        *[summary[closed] for summary in self._summaries],
+        num_customers=len(self.customer_ids), threshold_date=threshold,
+        initial=self._closed_aggregates())
+    self._summaries = tuple(summary[~closed] for summary in self._summaries)
+    self.materialized_threshold = threshold
+
+  def compute_features(self, threshold_date, predict_end, max_monetary,
+                       materialize=True):
+    """Computes the CLV features, like the module level compute_features.
+
+    If materialize is set, the days before threshold_date are materialized
+    first, so the next computation starts from the aggregates.
+    """
+
+    if materialize:
+      self.materialize(threshold_date)
+    elif (self.materialized_threshold is not None and
+          to_days(threshold_date) < self.materialized_threshold):
+      raise ValueError('The threshold cannot move backwards')
+
+    aggregates = aggregate_summaries(
+        *self._summaries, num_customers=len(self.customer_ids),
+        threshold_date=threshold_date, initial=self._closed_aggregates())
+    features = select_features(aggregates, threshold_date, predict_end,
+                               max_monetary)
+    return _features_frame(features, self.customer_ids.values)
@@ -44,20 +44,68 @@ def _fill_in_missing(x):
       axis=1)
 
 
+def _fill_in_missing_stacked(tensors):
+  """Replaces missing values in SparseTensors and stacks them as columns.
+
+  The SparseTensors hold at most one value per example. They are concatenated
+  into one [batch_size, len(tensors)] SparseTensor and densified once, so they
+  must have the same dtype.
+  """
+
+  if len(set(x.dtype for x in tensors)) > 1:
+    raise ValueError('Cannot stack SparseTensors of different dtypes')
+  default_value = '' if tensors[0].dtype == tf.string else 0
+  stacked = tf.sparse.to_dense(
+      tf.sparse.concat(
+          axis=1,
+          sp_inputs=[
+              tf.SparseTensor(x.indices, x.values, [x.dense_shape[0], 1])
+              for x in tensors
+          ]), default_value)
+  stacked.set_shape([None, len(tensors)])
+  return stacked
+
+
+def _fill_in_missing_by_dtype(inputs, keys):
+  """Stacks the features of each dtype with _fill_in_missing_stacked.
+
+  Returns a (keys, stacked) pair per dtype, so every feature keeps its dtype.
+  """
+
+  groups = []
+  for key in keys:
+    for group in groups:
+      if inputs[group[0]].dtype == inputs[key].dtype:
+        group.append(key)
+        break
+    else:
+      groups.append([key])
+  return [(group, _fill_in_missing_stacked([inputs[key] for key in group]))
+          for group in groups]
+
+
 def preprocessing_fn(inputs):
   """Preprocesses Covertype Dataset."""
 
   outputs = {}
 
-  # Scale numerical features
-  for key in NUMERIC_FEATURES_KEYS:
-    outputs[_transformed_name(key)] = tft.scale_to_z_score(
-        _fill_in_missing(inputs[key]))
+  # Scale numerical features, stacked in one tensor per dtype with a z-score
+  # per column
+  for keys, numeric_features in _fill_in_missing_by_dtype(
+      inputs, NUMERIC_FEATURES_KEYS):
+    scaled_features = tf.unstack(
+        tft.scale_to_z_score(numeric_features, elementwise=True),
+        num=len(keys), axis=1)
+    for key, scaled_feature in zip(keys, scaled_features):
+      outputs[_transformed_name(key)] = scaled_feature
 
   # Generate vocabularies and maps categorical features
-  for key in CATEGORICAL_FEATURES_KEYS:
-    outputs[_transformed_name(key)] = tft.compute_and_apply_vocabulary(
-        x=_fill_in_missing(inputs[key]), num_oov_buckets=1, vocab_filename=key)
+  for keys, categorical_features in _fill_in_missing_by_dtype(
+      inputs, CATEGORICAL_FEATURES_KEYS):
+    for key, feature in zip(
+        keys, tf.unstack(categorical_features, num=len(keys), axis=1)):
+      outputs[_transformed_name(key)] = tft.compute_and_apply_vocabulary(
+          x=feature, num_oov_buckets=1, vocab_filename=key)
 
   # Convert Cover_Type from 1-7 to 0-6
   outputs[_transformed_name(LABEL_KEY)] = _fill_in_missing(
@@ -0,0 +1,469 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local benchmarks for the Covertype TFX modules.
+
+Run in the pipeline's custom image, with TensorFlow 1.15 and TFX 0.15:
+
+  python benchmark.py transform
+  python benchmark.py input_pipeline
+  python benchmark.py serving
+"""
+
+import glob
+import json
+import os
+import tempfile
+import time
+
+import apache_beam as beam
+import fire
+import numpy as np
+import tensorflow as tf
+import tensorflow_transform as tft
+import tensorflow_transform.beam as tft_beam
+from tensorflow_transform.tf_metadata import dataset_metadata
+from tensorflow_transform.tf_metadata import schema_utils
+
+import transform_train
+
+NUMERIC_FEATURE_RANGES = [
+    ('Elevation', 1859, 3858),
+    ('Aspect', 0, 360),
+    ('Slope', 0, 66),
+    ('Horizontal_Distance_To_Hydrology', 0, 1397),
+    ('Vertical_Distance_To_Hydrology', -173, 601),
+    ('Horizontal_Distance_To_Roadways', 0, 7117),
+    ('Hillshade_9am', 0, 254),
+    ('Hillshade_Noon', 0, 254),
+    ('Hillshade_3pm', 0, 254),
+    ('Horizontal_Distance_To_Fire_Points', 0, 7173),
+]
+WILDERNESS_AREAS = ['Rawah', 'Neota', 'Commanche', 'Cache']
+SOIL_TYPES = ['C{}'.format(code) for code in range(2702, 2742)]
+
+
+def raw_feature_spec():
+  """Returns the raw feature spec inferred by the pipeline for Covertype."""
+
+  feature_spec = {
+      key: tf.io.VarLenFeature(tf.int64)
+      for key in transform_train.NUMERIC_FEATURE_KEYS +
+      [transform_train.LABEL_KEY]
+  }
+  feature_spec.update({
+      key: tf.io.VarLenFeature(tf.string)
+      for key in transform_train.CATEGORICAL_FEATURE_KEYS
+  })
+  return feature_spec
+
+
+def synthetic_examples(num_examples, missing_rate=0.01, seed=0):
+  """Generates raw Covertype instances with a few missing values."""
+
+  rng = np.random.RandomState(seed)
+  columns = {
+      name: rng.randint(low, high + 1, size=num_examples).tolist()
+      for name, low, high in NUMERIC_FEATURE_RANGES
+  }
+  columns['Wilderness_Area'] = rng.choice(WILDERNESS_AREAS,
+                                          size=num_examples).tolist()
+  columns['Soil_Type'] = rng.choice(SOIL_TYPES, size=num_examples).tolist()
+  columns[transform_train.LABEL_KEY] = rng.randint(
+      1, 8, size=num_examples).tolist()
+  missing = rng.rand(num_examples, len(columns)) < missing_rate
+
+  return [{
+      key: [] if missing[index, column] and key != transform_train.LABEL_KEY
+      else [values[index]]
+      for column, (key, values) in enumerate(sorted(columns.items()))
+  } for index in range(num_examples)]
+
+
+def _per_feature_preprocessing_fn(inputs):
+  """The preprocessing_fn with one sparse to dense conversion per feature."""
+
+  outputs = {}
+  for key in transform_train.NUMERIC_FEATURE_KEYS:
+    outputs[transform_train._transformed_name(key)] = tft.scale_to_z_score(
+        transform_train._fill_in_missing(inputs[key]))
+  for key in transform_train.CATEGORICAL_FEATURE_KEYS:
+    outputs[transform_train._transformed_name(
+        key)] = tft.compute_and_apply_vocabulary(
+            x=transform_train._fill_in_missing(inputs[key]),
+            num_oov_buckets=1, vocab_filename=key)
+  outputs[transform_train._transformed_name(
+      transform_train.LABEL_KEY)] = transform_train._fill_in_missing(
+          inputs[transform_train.LABEL_KEY]) - 1
+  return outputs
+
+
+def _analyze(preprocessing_fn, examples, metadata, transform_fn_dir,
+             temp_dir):
+  """Computes the transform function of preprocessing_fn on DirectRunner."""
+
+  with beam.Pipeline(runner='DirectRunner') as pipeline:
+    with tft_beam.Context(temp_dir=temp_dir):
+      transform_fn = ((pipeline | beam.Create(examples), metadata)
+                      | tft_beam.AnalyzeDataset(preprocessing_fn))
+      _ = transform_fn | tft_beam.WriteTransformFn(transform_fn_dir)
+
+
+def _transform(examples, metadata, transform_fn_dir, output_prefix, temp_dir,
+               batch_size):
+  """Applies a transform function on DirectRunner and returns the outputs."""
+
+  with beam.Pipeline(runner='DirectRunner') as pipeline:
+    with tft_beam.Context(temp_dir=temp_dir, desired_batch_size=batch_size):
+      transform_fn = pipeline | tft_beam.ReadTransformFn(transform_fn_dir)
+      transformed, _ = (((pipeline | beam.Create(examples), metadata),
+                         transform_fn) | tft_beam.TransformDataset())
+      _ = (transformed
+           | beam.Map(lambda instance: json.dumps(
+               {key: np.asarray(value).item()
+                for key, value in instance.items()}, sort_keys=True))
+           | beam.io.WriteToText(output_prefix))
+
+  rows = []
+  for path in glob.glob(output_prefix + '*'):
+    with open(path) as output_file:
+      rows.extend(json.loads(line) for line in output_file)
+  return rows
+
+
+def _sorted_outputs(rows):
+  """Returns the output columns with the rows in a canonical order."""
+
+  keys = sorted(rows[0])
+  columns = np.array([[row[key] for key in keys] for row in rows])
+  return keys, columns[np.lexsort(columns.T[::-1])]
+
+
+def transform(num_examples=100000, batch_sizes=(100, 1000), repeats=3):
+  """Compares the stacked preprocessing_fn with the per feature variant.
+
+  Both preprocessing functions are analyzed and applied to the same
+  synthetic examples with the Beam DirectRunner. Reports the analysis time
+  and the best transform throughput for each batch size, and checks that
+  both variants produce the same transformed features.
+  """
+
+  if isinstance(batch_sizes, int):
+    batch_sizes = [batch_sizes]
+  examples = synthetic_examples(num_examples)
+  metadata = dataset_metadata.DatasetMetadata(
+      schema_utils.schema_from_feature_spec(raw_feature_spec()))
+  variants = [
+      ('per feature', _per_feature_preprocessing_fn),
+      ('stacked', transform_train.preprocessing_fn),
+  ]
+
+  outputs = []
+  print('{:>12} {:>10} {:>10} {:>14}'.format('variant', 'batch', 'analyze',
+                                             'examples/sec'))
+  with tempfile.TemporaryDirectory() as workdir:
+    for name, preprocessing_fn in variants:
+      variant_dir = os.path.join(workdir, name.replace(' ', '_'))
+      temp_dir = os.path.join(variant_dir, 'tmp')
+      transform_fn_dir = os.path.join(variant_dir, 'transform_fn')
+
+      start = time.time()
+      _analyze(preprocessing_fn, examples, metadata, transform_fn_dir,
+               temp_dir)
+      analyze_time = time.time() - start
+
+      for batch_size in batch_sizes:
+        timings = []
+        for repeat in range(repeats):
+          output_prefix = os.path.join(
+              variant_dir, 'output-{}-{}'.format(batch_size, repeat))
+          start = time.time()
+          rows = _transform(examples, metadata, transform_fn_dir,
+                            output_prefix, temp_dir, batch_size)
+          timings.append(time.time() - start)
+        print('{:>12} {:>10} {:>9.2f}s {:>14.0f}'.format(
+            name, batch_size, analyze_time, num_examples / min(timings)))
+      outputs.append(_sorted_outputs(rows))
+
+  (keys, expected), (other_keys, actual) = outputs
+  assert keys == other_keys, (keys, other_keys)
+  np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+  print('The transformed features of both variants match')
+
+
+def transformed_feature_spec():
+  """Returns the feature spec of the transformed Covertype features."""
+
+  feature_spec = {
+      transform_train._transformed_name(key): tf.io.FixedLenFeature(
+          [], tf.float32) for key in transform_train.NUMERIC_FEATURE_KEYS
+  }
+  feature_spec.update({
+      transform_train._transformed_name(key): tf.io.FixedLenFeature(
+          [], tf.int64) for key in transform_train.CATEGORICAL_FEATURE_KEYS +
+      [transform_train.LABEL_KEY]
+  })
+  return feature_spec
+
+
+def write_transformed_shards(output_dir, num_examples, num_shards, seed=0):
+  """Writes synthetic transformed examples to gzip'ed TFRecord shards.
+
+  Returns the file pattern of the shards.
+  """
+
+  rng = np.random.RandomState(seed)
+  feature_spec = transformed_feature_spec()
+  options = tf.io.TFRecordOptions(compression_type='GZIP')
+  for shard, indexes in enumerate(
+      np.array_split(np.arange(num_examples), num_shards)):
+    path = os.path.join(output_dir, 'transformed-{:05d}.gz'.format(shard))
+    with tf.io.TFRecordWriter(path, options) as writer:
+      for _ in indexes:
+        features = {}
+        for key, spec in feature_spec.items():
+          if spec.dtype == tf.float32:
+            features[key] = tf.train.Feature(float_list=tf.train.FloatList(
+                value=[rng.randn()]))
+          else:
+            features[key] = tf.train.Feature(int64_list=tf.train.Int64List(
+                value=[rng.randint(transform_train.NUM_CLASSES)]))
+        writer.write(tf.train.Example(features=tf.train.Features(
+            feature=features)).SerializeToString())
+  return os.path.join(output_dir, 'transformed-*.gz')
+
+
+def _baseline_input_fn(filenames, feature_specs, label_key, batch_size=200):
+  """The input_fn with the make_batched_features_dataset defaults."""
+
+  return tf.data.experimental.make_batched_features_dataset(
+      file_pattern=filenames,
+      batch_size=batch_size,
+      features=feature_specs,
+      label_key=label_key,
+      reader=transform_train._gzip_reader_fn)
+
+
+def _examples_per_second(input_fn, batch_size, num_batches, warmup_batches):
+  """Measures the throughput of the batches of an input_fn."""
+
+  with tf.Graph().as_default():
+    batch = tf.compat.v1.data.make_one_shot_iterator(input_fn()).get_next()
+    with tf.compat.v1.Session() as session:
+      for _ in range(warmup_batches):
+        session.run(batch)
+      start = time.time()
+      for _ in range(num_batches):
+        session.run(batch)
+      return batch_size * num_batches / (time.time() - start)
+
+
+def input_pipeline(num_examples=200000, num_shards=8, batch_size=200,
+                   num_batches=2000):
+  """Compares the throughput of the baseline and the tuned input_fn.
+
+  The training input functions are measured after a short warmup. The
+  evaluation input functions are measured after one full epoch, so that
+  the cached variant reads its cache.
+  """
+
+  feature_spec = transformed_feature_spec()
+  label_key = transform_train._transformed_name(transform_train.LABEL_KEY)
+  settings = dict(transform_train.INPUT_PIPELINE_DEFAULTS)
+  settings.pop('eval_cache')
+  epoch_batches = num_examples // batch_size
+
+  with tempfile.TemporaryDirectory() as workdir:
+    file_pattern = write_transformed_shards(workdir, num_examples, num_shards)
+    variants = [
+        ('baseline', 10, lambda: _baseline_input_fn(
+            file_pattern, feature_spec.copy(), label_key, batch_size)),
+        ('parallel', 10, lambda: transform_train._input_fn(
+            file_pattern, feature_spec.copy(), label_key, batch_size,
+            **settings)),
+        ('eval uncached', epoch_batches, lambda: transform_train._input_fn(
+            file_pattern, feature_spec.copy(), label_key, batch_size,
+            **settings)),
+        ('eval cached', epoch_batches, lambda: transform_train._input_fn(
+            file_pattern, feature_spec.copy(), label_key, batch_size,
+            cache='memory', **settings)),
+    ]
+
+    print('{:>14} {:>14}'.format('input_fn', 'examples/sec'))
+    for name, warmup_batches, input_fn in variants:
+      print('{:>14} {:>14.0f}'.format(name, _examples_per_second(
+          input_fn, batch_size, num_batches, warmup_batches)))
+
+
+def _serialized_examples(examples):
+  """Serializes raw Covertype instances as tf.Example protos."""
+
+  serialized = []
+  for instance in examples:
+    features = {}
+    for key, values in instance.items():
+      if key == transform_train.LABEL_KEY or not values:
+        continue
+      if key in transform_train.CATEGORICAL_FEATURE_KEYS:
+        features[key] = tf.train.Feature(bytes_list=tf.train.BytesList(
+            value=[value.encode('utf-8') for value in values]))
+      else:
+        features[key] = tf.train.Feature(int64_list=tf.train.Int64List(
+            value=values))
+    serialized.append(tf.train.Example(features=tf.train.Features(
+        feature=features)).SerializeToString())
+  return np.array(serialized, dtype=object)
+
+
+def _dense_features(examples):
+  """Returns the raw features as dense arrays, with 0 or '' if missing."""
+
+  dense_features = {}
+  for key in transform_train.NUMERIC_FEATURE_KEYS:
+    dense_features[key] = np.array(
+        [instance[key][0] if instance[key] else 0 for instance in examples],
+        dtype=np.int64)
+  for key in transform_train.CATEGORICAL_FEATURE_KEYS:
+    dense_features[key] = np.array(
+        [instance[key][0].encode('utf-8') if instance[key] else b''
+         for instance in examples], dtype=object)
+  return dense_features
+
+
+def export_serving_model(examples, workdir, train_steps=10):
+  """Exports the serving model of the trainer_fn for synthetic examples.
+
+  The transform function is analyzed on the examples, and the estimator is
+  trained for a few steps on random transformed features, which does not
+  change the serving latency. Returns the export directory.
+  """
+
+  schema = schema_utils.schema_from_feature_spec(raw_feature_spec())
+  transform_output_dir = os.path.join(workdir, 'transform_output')
+  _analyze(transform_train.preprocessing_fn, examples,
+           dataset_metadata.DatasetMetadata(schema), transform_output_dir,
+           os.path.join(workdir, 'tmp'))
+  tf_transform_output = tft.TFTransformOutput(transform_output_dir)
+
+  categorical_feature_keys = [
+      (transform_train._transformed_name(key),
+       tf_transform_output.num_buckets_for_transformed_feature(
+           transform_train._transformed_name(key)))
+      for key in transform_train.CATEGORICAL_FEATURE_KEYS
+  ]
+  estimator = transform_train._build_estimator(
+      config=tf.estimator.RunConfig(model_dir=os.path.join(workdir, 'model')),
+      numeric_feature_keys=[
+          transform_train._transformed_name(key)
+          for key in transform_train.NUMERIC_FEATURE_KEYS
+      ],
+      categorical_feature_keys=categorical_feature_keys,
+      hidden_units=transform_train.TRAINING_DEFAULTS['hidden_units'])
+
+  def random_input_fn(batch_size=256):
+    features = {
+        transform_train._transformed_name(key): tf.random.normal([batch_size])
+        for key in transform_train.NUMERIC_FEATURE_KEYS
+    }
+    features.update({
+        key: tf.random.uniform([batch_size], maxval=num_buckets,
+                               dtype=tf.int64)
+        for key, num_buckets in categorical_feature_keys
+    })
+    labels = tf.random.uniform([batch_size], maxval=transform_train.NUM_CLASSES,
+                               dtype=tf.int64)
+    return features, labels
+
+  estimator.train(random_input_fn, steps=train_steps)
+  export_dir = estimator.export_saved_model(
+      os.path.join(workdir, 'export'),
+      lambda: transform_train._example_serving_receiver_fn(
+          tf_transform_output, schema, transform_train.LABEL_KEY))
+  return export_dir.decode('utf-8')
+
+
+def _latencies(session, signature, feeds, num_requests, warmup_requests=10):
+  """Returns the latencies in ms of the probabilities of a signature."""
+
+  fetch = signature.outputs['probabilities'].name
+  feeds = [{
+      signature.inputs[key].name: value for key, value in feed.items()
+  } for feed in feeds]
+
+  for request in range(warmup_requests):
+    session.run(fetch, feeds[request % len(feeds)])
+  latencies = []
+  for request in range(num_requests):
+    start = time.time()
+    session.run(fetch, feeds[request % len(feeds)])
+    latencies.append(time.time() - start)
+  return 1000 * np.array(latencies)
+
+
+def serving(num_examples=10000, batch_sizes=(1, 256), num_requests=1000):
+  """Compares the latency of the tf.Example and the raw features signatures.
+
+  The serving model is exported, loaded in process and queried with
+  batches of synthetic examples through its 'predict' and
+  'raw_features:predict' signatures. Reports the p50 and p99 latencies for
+  each batch size, and checks that both signatures return the same
+  probabilities.
+  """
+
+  if isinstance(batch_sizes, int):
+    batch_sizes = [batch_sizes]
+  examples = synthetic_examples(num_examples)
+  serialized = _serialized_examples(examples)
+  dense_features = _dense_features(examples)
+
+  with tempfile.TemporaryDirectory() as workdir:
+    export_dir = export_serving_model(examples, workdir)
+    with tf.Graph().as_default(), tf.compat.v1.Session() as session:
+      signatures = tf.compat.v1.saved_model.loader.load(
+          session, [tf.saved_model.SERVING], export_dir).signature_def
+      example_signature = signatures['predict']
+      raw_signature = signatures['raw_features:predict']
+
+      print('{:>14} {:>8} {:>10} {:>10}'.format('signature', 'batch',
+                                                'p50 ms', 'p99 ms'))
+      for batch_size in batch_sizes:
+        batches = [
+            slice(start, start + batch_size)
+            for start in range(0, num_examples - batch_size + 1, batch_size)
+        ]
+        example_feeds = [{'examples': serialized[batch]} for batch in batches]
+        raw_feeds = [{
+            key: values[batch] for key, values in dense_features.items()
+        } for batch in batches]
+
+        for name, signature, feeds in [
+            ('tf.Example', example_signature, example_feeds),
+            ('raw features', raw_signature, raw_feeds)]:
+          latencies = _latencies(session, signature, feeds, num_requests)
+          print('{:>14} {:>8} {:>10.2f} {:>10.2f}'.format(
+              name, batch_size, np.percentile(latencies, 50),
+              np.percentile(latencies, 99)))
+
+        expected, actual = [
+            session.run(signature.outputs['probabilities'].name, {
+                signature.inputs[key].name: value
+                for key, value in feeds[0].items()
+            }) for signature, feeds in [(example_signature, example_feeds),
+                                        (raw_signature, raw_feeds)]
+        ]
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+  print('The probabilities of both signatures match')
+
+
+if __name__ == '__main__':
+  fire.Fire()
@@ -13,6 +13,9 @@
 # limitations under the License.
 """Data processing and training functions for Covertype TFX pipeline."""
 
+import sys
+import time
+
 import tensorflow as tf
 import tensorflow_model_analysis as tfma
 import tensorflow_transform as tft
@@ -30,6 +33,39 @@ CATEGORICAL_FEATURE_KEYS = ['Wilderness_Area', 'Soil_Type']
 LABEL_KEY = 'Cover_Type'
 NUM_CLASSES = 7
 
+# The defaults of the input pipeline settings that can be overridden in the
+# hparams or the custom_config of the Trainer
+INPUT_PIPELINE_DEFAULTS = {
+    'reader_num_threads': 4,
+    'parser_num_threads': 4,
+    'shuffle_buffer_size': 10000,
+    'read_buffer_size': 8 * 1024 * 1024,
+    # '' to always read the evaluation files, 'memory' to cache the parsed
+    # evaluation batches for the repeated epochs of an evaluation, or a path
+    # to cache them in files that are reused by the following evaluations
+    'eval_cache': 'memory',
+}
+
+# The defaults of the training settings that can be overridden in the
+# hparams or the custom_config of the Trainer
+TRAINING_DEFAULTS = {
+    'train_batch_size': 256,
+    'eval_batch_size': 256,
+    'hidden_units': [128, 64],
+    # Checkpoints are saved every save_checkpoints_secs seconds, unless
+    # save_checkpoints_steps is set
+    'save_checkpoints_steps': None,
+    'save_checkpoints_secs': 600,
+    'keep_checkpoint_max': 1,
+    'log_step_count_steps': 100,
+    # The model is evaluated on a new checkpoint if eval_throttle_secs have
+    # passed since the last evaluation. With eval_only_at_end, only the
+    # final checkpoint is saved and evaluated.
+    'eval_throttle_secs': 600,
+    'eval_start_delay_secs': 120,
+    'eval_only_at_end': False,
+}
+
 EXPORTED_MODEL_NAME = 'covertype-classifier'
 
 ### Helper functions used by the preprocessing_fn and trainer_fn
@@ -50,14 +86,185 @@ def _fill_in_missing(x):
       axis=1)
 
 
+def _fill_in_missing_stacked(tensors):
+  """Replaces missing values in SparseTensors and stacks them as columns.
+
+  The SparseTensors hold at most one value per example. They are concatenated
+  into one [batch_size, len(tensors)] SparseTensor and densified once, so they
+  must have the same dtype.
+  """
+
+  if len(set(x.dtype for x in tensors)) > 1:
+    raise ValueError('Cannot stack SparseTensors of different dtypes')
+  default_value = '' if tensors[0].dtype == tf.string else 0
+  stacked = tf.sparse.to_dense(
+      tf.sparse.concat(
+          axis=1,
+          sp_inputs=[
+              tf.SparseTensor(x.indices, x.values, [x.dense_shape[0], 1])
+              for x in tensors
+          ]), default_value)
+  stacked.set_shape([None, len(tensors)])
+  return stacked
+
+
+def _fill_in_missing_by_dtype(inputs, keys):
+  """Stacks the features of each dtype with _fill_in_missing_stacked.
+
+  Returns a (keys, stacked) pair per dtype, so every feature keeps its dtype.
+  """
+
+  groups = []
+  for key in keys:
+    for group in groups:
+      if inputs[group[0]].dtype == inputs[key].dtype:
+        group.append(key)
+        break
+    else:
+      groups.append([key])
+  return [(group, _fill_in_missing_stacked([inputs[key] for key in group]))
+          for group in groups]
+
+
 def _get_raw_feature_spec(schema):
   return schema_utils.schema_as_feature_spec(schema).feature_spec
 
 
-def _gzip_reader_fn(filenames):
+def _get_hparam(hparams, name, default=None):
+  """Returns a setting from the hparams or from their custom_config."""
+
+  value = getattr(hparams, name, None)
+  if value is None:
+    custom_config = getattr(hparams, 'custom_config', None) or {}
+    value = custom_config.get(name)
+  return default if value is None else value
+
+
+def _get_hidden_units(hparams, default):
+  """Returns the hidden units as a list, also accepting '128,64' strings."""
+
+  hidden_units = _get_hparam(hparams, 'hidden_units', default)
+  if isinstance(hidden_units, str):
+    hidden_units = hidden_units.split(',')
+  return [int(units) for units in hidden_units]
+
+
+class _ThroughputLoggingHook(tf.estimator.SessionRunHook):
+  """Logs the training steps/sec and examples/sec.
+
+  The throughput is also written as summaries to output_dir, next to the
+  global_step/sec summaries of the estimator.
+  """
+
+  def __init__(self, batch_size, every_n_steps=100, output_dir=None):
+    self._batch_size = batch_size
+    self._timer = tf.compat.v1.train.SecondOrStepTimer(
+        every_steps=every_n_steps)
+    self._output_dir = output_dir
+
+  def begin(self):
+    self._global_step = tf.compat.v1.train.get_global_step()
+    self._summary_writer = None
+    if self._output_dir:
+      self._summary_writer = tf.compat.v1.summary.FileWriterCache.get(
+          self._output_dir)
+
+  def before_run(self, run_context):
+    return tf.estimator.SessionRunArgs(self._global_step)
+
+  def after_run(self, run_context, run_values):
+    global_step = run_values.results
+    if not self._timer.should_trigger_for_step(global_step):
+      return
+    elapsed_secs, elapsed_steps = self._timer.update_last_triggered_step(
+        global_step)
+    if not elapsed_secs:
+      return
+
+    steps_per_sec = elapsed_steps / elapsed_secs
+    examples_per_sec = steps_per_sec * self._batch_size
+    tf.compat.v1.logging.info(
+        'Step %d: %.2f steps/sec, %.1f examples/sec', global_step,
+        steps_per_sec, examples_per_sec)
+    if self._summary_writer:
+      self._summary_writer.add_summary(
+          tf.compat.v1.Summary(value=[
+              tf.compat.v1.Summary.Value(
+                  tag='steps/sec', simple_value=steps_per_sec),
+              tf.compat.v1.Summary.Value(
+                  tag='examples/sec', simple_value=examples_per_sec),
+          ]), global_step)
+
+
+class _WallClockLoggingHook(tf.estimator.SessionRunHook):
+  """Logs the split of the wall-clock time between steps, checkpoints and eval.
+
+  The checkpoints are timed by the saving listener returned by listener().
+  train_and_evaluate evaluates right after saving a checkpoint, so the time
+  between a checkpoint and the next training step is counted as evaluation.
+  The final evaluation, after the last training step, is not included.
+  """
+
+  def __init__(self, every_n_steps=100):
+    self._every_n_steps = every_n_steps
+    self._secs = {'train': 0.0, 'checkpoint': 0.0, 'eval': 0.0}
+    self._saved_at = None
+    self._num_steps = 0
+
+  def listener(self):
+    return _CheckpointTimingListener(self)
+
+  def checkpoint_saved(self, secs):
+    self._saved_at = time.time()
+    self._secs['checkpoint'] += secs
+
+  def log(self, global_step):
+    total = sum(self._secs.values()) or 1.0
+    tf.compat.v1.logging.info(
+        'Step %d: training %.1fs (%.0f%%), checkpoints %.1fs (%.0f%%), '
+        'evaluation %.1fs (%.0f%%)', global_step, self._secs['train'],
+        100 * self._secs['train'] / total, self._secs['checkpoint'],
+        100 * self._secs['checkpoint'] / total, self._secs['eval'],
+        100 * self._secs['eval'] / total)
+
+  def begin(self):
+    self._global_step = tf.compat.v1.train.get_global_step()
+
+  def before_run(self, run_context):
+    self._step_started_at = time.time()
+    if self._saved_at is not None:
+      self._secs['eval'] += self._step_started_at - self._saved_at
+      self._saved_at = None
+    return tf.estimator.SessionRunArgs(self._global_step)
+
+  def after_run(self, run_context, run_values):
+    self._secs['train'] += time.time() - self._step_started_at
+    self._num_steps += 1
+    if self._num_steps % self._every_n_steps == 0:
+      self.log(run_values.results)
+
+
+class _CheckpointTimingListener(tf.compat.v1.train.CheckpointSaverListener):
+  """Reports the time spent saving checkpoints to a _WallClockLoggingHook."""
+
+  def __init__(self, hook):
+    self._hook = hook
+
+  def before_save(self, session, global_step_value):
+    self._save_started_at = time.time()
+
+  def after_save(self, session, global_step_value):
+    self._hook.checkpoint_saved(time.time() - self._save_started_at)
+
+  def end(self, session, global_step_value):
+    self._hook.log(global_step_value)
+
+
+def _gzip_reader_fn(filenames, buffer_size=None):
   """Small utility returning a record reader that can read gzip'ed files."""
 
-  return tf.data.TFRecordDataset(filenames, compression_type='GZIP')
+  return tf.data.TFRecordDataset(
+      filenames, compression_type='GZIP', buffer_size=buffer_size)
 
 
 def _build_estimator(config,
@@ -85,21 +292,67 @@ def _build_estimator(config,
       warm_start_from=warm_start_from)
 
 
-def _input_fn(filenames, feature_specs, label_key, batch_size=200):
-  """Generates features and labels for training or evaluation."""
+def _input_fn(filenames,
+              feature_specs,
+              label_key,
+              batch_size=200,
+              num_epochs=None,
+              shuffle=True,
+              shuffle_buffer_size=10000,
+              reader_num_threads=4,
+              parser_num_threads=4,
+              read_buffer_size=None,
+              cache=None):
+  """Generates features and labels for training or evaluation.
+
+  The transformed shards are read with reader_num_threads parallel readers
+  and the examples are parsed in batches with parser_num_threads threads.
+  The batches are prefetched with an autotuned buffer. If cache is set, the
+  parsed batches of the first epoch are cached, in memory if cache is
+  'memory' or in files with the cache path prefix otherwise, and the
+  following epochs read the cache instead of the compressed files.
+  """
 
   dataset = tf.data.experimental.make_batched_features_dataset(
       file_pattern=filenames,
       batch_size=batch_size,
       features=feature_specs,
       label_key=label_key,
-      reader=_gzip_reader_fn)
+      reader=_gzip_reader_fn,
+      reader_args=[read_buffer_size],
+      num_epochs=1 if cache else num_epochs,
+      shuffle=shuffle,
+      shuffle_buffer_size=shuffle_buffer_size,
+      reader_num_threads=reader_num_threads,
+      parser_num_threads=parser_num_threads,
+      prefetch_buffer_size=tf.data.experimental.AUTOTUNE)
+
+  if cache:
+    dataset = dataset.cache('' if cache == 'memory' else cache)
+    dataset = dataset.repeat(num_epochs).prefetch(
+        tf.data.experimental.AUTOTUNE)
 
   return dataset
 
 
+def _to_sparse(x):
+  """Converts a dense feature with one value per instance to a SparseTensor."""
+
+  batch_size = tf.shape(x, out_type=tf.int64)[0]
+  indices = tf.stack(
+      [tf.range(batch_size), tf.zeros([batch_size], dtype=tf.int64)], axis=1)
+  return tf.SparseTensor(indices, x, dense_shape=[batch_size, 1])
+
+
 def _example_serving_receiver_fn(tf_transform_output, schema, label_key):
-  """Build the serving graph."""
+  """Build the serving graph.
+
+  The default signatures take serialized tf.Example protos. The alternative
+  'raw_features' signatures take the raw features as dense typed tensors
+  with one value per instance, missing values being sent as 0 or '', and
+  skip the parsing. The vocabulary tables of the transform graph are
+  initialized when the SavedModel is loaded.
+  """
 
   raw_feature_spec = _get_raw_feature_spec(schema)
   raw_feature_spec.pop(label_key)
@@ -108,11 +361,19 @@ def _example_serving_receiver_fn(tf_transform_output, schema, label_key):
       raw_feature_spec, default_batch_size=None)
   serving_input_receiver = raw_input_fn()
 
+  # Feeding the dense features cuts the parsing of the examples off
+  dense_features = {
+      key: tf.compat.v1.placeholder_with_default(
+          _fill_in_missing(feature), shape=[None], name=key)
+      for key, feature in serving_input_receiver.features.items()
+  }
   transformed_features = tf_transform_output.transform_raw_features(
-      serving_input_receiver.features)
+      {key: _to_sparse(feature) for key, feature in dense_features.items()})
 
   return tf.estimator.export.ServingInputReceiver(
-      transformed_features, serving_input_receiver.receiver_tensors)
+      transformed_features,
+      serving_input_receiver.receiver_tensors,
+      receiver_tensors_alternatives={'raw_features': dense_features})
 
 
 def _eval_input_receiver_fn(tf_transform_output, schema, label_key):
@@ -144,15 +405,23 @@ def preprocessing_fn(inputs):
 
   outputs = {}
 
-  # Scale numerical features
-  for key in NUMERIC_FEATURE_KEYS:
-    outputs[_transformed_name(key)] = tft.scale_to_z_score(
-        _fill_in_missing(inputs[key]))
+  # Scale numerical features, stacked in one tensor per dtype with a z-score
+  # per column
+  for keys, numeric_features in _fill_in_missing_by_dtype(
+      inputs, NUMERIC_FEATURE_KEYS):
+    scaled_features = tf.unstack(
+        tft.scale_to_z_score(numeric_features, elementwise=True),
+        num=len(keys), axis=1)
+    for key, scaled_feature in zip(keys, scaled_features):
+      outputs[_transformed_name(key)] = scaled_feature
 
   # Generate vocabularies and maps categorical features
-  for key in CATEGORICAL_FEATURE_KEYS:
-    outputs[_transformed_name(key)] = tft.compute_and_apply_vocabulary(
-        x=_fill_in_missing(inputs[key]), num_oov_buckets=1, vocab_filename=key)
+  for keys, categorical_features in _fill_in_missing_by_dtype(
+      inputs, CATEGORICAL_FEATURE_KEYS):
+    for key, feature in zip(
+        keys, tf.unstack(categorical_features, num=len(keys), axis=1)):
+      outputs[_transformed_name(key)] = tft.compute_and_apply_vocabulary(
+          x=feature, num_oov_buckets=1, vocab_filename=key)
 
   # Convert Cover_Type from 1-7 to 0-6
   outputs[_transformed_name(LABEL_KEY)] = _fill_in_missing(
@@ -165,9 +434,26 @@ def preprocessing_fn(inputs):
 def trainer_fn(hparams, schema):
   """Trains CoverType classifier."""
 
-  train_batch_size = 40
-  eval_batch_size = 40
-  hidden_units = [128, 64]
+  train_batch_size = _get_hparam(hparams, 'train_batch_size',
+                                 TRAINING_DEFAULTS['train_batch_size'])
+  eval_batch_size = _get_hparam(hparams, 'eval_batch_size',
+                                TRAINING_DEFAULTS['eval_batch_size'])
+  hidden_units = _get_hidden_units(hparams, TRAINING_DEFAULTS['hidden_units'])
+  train_steps = _get_hparam(hparams, 'train_steps')
+  eval_steps = _get_hparam(hparams, 'eval_steps')
+  log_step_count_steps = _get_hparam(hparams, 'log_step_count_steps',
+                                     TRAINING_DEFAULTS['log_step_count_steps'])
+  save_checkpoints_steps = _get_hparam(
+      hparams, 'save_checkpoints_steps',
+      TRAINING_DEFAULTS['save_checkpoints_steps'])
+  save_checkpoints_secs = None if save_checkpoints_steps else _get_hparam(
+      hparams, 'save_checkpoints_secs',
+      TRAINING_DEFAULTS['save_checkpoints_secs'])
+  if _get_hparam(hparams, 'eval_only_at_end',
+                 TRAINING_DEFAULTS['eval_only_at_end']):
+    # Saves checkpoints only at the start and the end of training, and
+    # train_and_evaluate never evaluates the first one
+    save_checkpoints_steps, save_checkpoints_secs = None, sys.maxsize
 
   # Retrieve transformed feature specs
   tf_transform_output = tft.TFTransformOutput(hparams.transform_output)
@@ -189,23 +475,59 @@ def trainer_fn(hparams, schema):
            _transformed_name(key))) for key in CATEGORICAL_FEATURE_KEYS
   ]
 
+  input_settings = {
+      name: _get_hparam(hparams, name, default)
+      for name, default in INPUT_PIPELINE_DEFAULTS.items()
+  }
+  eval_cache = input_settings.pop('eval_cache')
+
   # Create a training input function
   train_input_fn = lambda: _input_fn(
       filenames=hparams.train_files,
       feature_specs=tf_transform_output.transformed_feature_spec().copy(),
       batch_size=train_batch_size,
-      label_key=transformed_label_key)
+      label_key=transformed_label_key,
+      **input_settings)
 
-  # Create an evaluation input function
+  # Create an evaluation input function that caches the parsed evaluation set
   eval_input_fn = lambda: _input_fn(
       filenames=hparams.eval_files,
       feature_specs=tf_transform_output.transformed_feature_spec().copy(),
       batch_size=eval_batch_size,
-      label_key=transformed_label_key)
+      label_key=transformed_label_key,
+      cache=eval_cache,
+      **input_settings)
+
+  # Create runtime config
+  run_config = tf.estimator.RunConfig(
+      save_checkpoints_steps=save_checkpoints_steps,
+      save_checkpoints_secs=save_checkpoints_secs,
+      keep_checkpoint_max=_get_hparam(hparams, 'keep_checkpoint_max',
+                                      TRAINING_DEFAULTS['keep_checkpoint_max']),
+      log_step_count_steps=log_step_count_steps)
+
+  run_config = run_config.replace(model_dir=hparams.serving_model_dir)
 
   # Create a training specification
+  train_hooks = [
+      _ThroughputLoggingHook(
+          train_batch_size, every_n_steps=log_step_count_steps,
+          output_dir=hparams.serving_model_dir)
+  ]
+  if run_config.is_chief:
+    # The estimator adds the evaluation listener of train_and_evaluate to
+    # this saver hook instead of creating its own, after the timing listener
+    wall_clock_hook = _WallClockLoggingHook(every_n_steps=log_step_count_steps)
+    train_hooks += [
+        wall_clock_hook,
+        tf.estimator.CheckpointSaverHook(
+            hparams.serving_model_dir,
+            save_secs=save_checkpoints_secs,
+            save_steps=save_checkpoints_steps,
+            listeners=[wall_clock_hook.listener()])
+    ]
   train_spec = tf.estimator.TrainSpec(
-      train_input_fn, max_steps=hparams.train_steps)
+      train_input_fn, max_steps=train_steps, hooks=train_hooks)
 
   # Create an evaluation specifaction
   serving_receiver_fn = lambda: _example_serving_receiver_fn(
@@ -215,15 +537,13 @@ def trainer_fn(hparams, schema):
 
   eval_spec = tf.estimator.EvalSpec(
       eval_input_fn,
-      steps=hparams.eval_steps,
+      steps=eval_steps,
       exporters=[exporter],
-      name=EXPORTED_MODEL_NAME)
-
-  # Create runtime config
-  run_config = tf.estimator.RunConfig(
-      save_checkpoints_steps=999, keep_checkpoint_max=1)
-
-  run_config = run_config.replace(model_dir=hparams.serving_model_dir)
+      name=EXPORTED_MODEL_NAME,
+      start_delay_secs=_get_hparam(hparams, 'eval_start_delay_secs',
+                                   TRAINING_DEFAULTS['eval_start_delay_secs']),
+      throttle_secs=_get_hparam(hparams, 'eval_throttle_secs',
+                                TRAINING_DEFAULTS['eval_throttle_secs']))
 
   # Build an estimator
   estimator = _build_estimator(